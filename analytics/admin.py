@@ -19,10 +19,37 @@
 #########################################################################
 
 from analytics.models import Analysis, GeoMondrianRole
+from analytics.bulk import bulk_delete_analyses
 from django.contrib import admin
+from django.contrib.admin.actions import delete_selected
+from django.core.exceptions import PermissionDenied
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+def delete_selected_analyses(modeladmin, request, queryset):
+    """
+    Replaces the default delete action: the confirmation page and the log
+    entries are the same but the analyses are deleted with
+    bulk_delete_analyses.
+    """
+    if not request.POST.get('post'):
+        return delete_selected(modeladmin, request, queryset)
+
+    if not modeladmin.has_delete_permission(request):
+        raise PermissionDenied
+    for obj in queryset:
+        modeladmin.log_deletion(request, obj, force_text(obj))
+    count = bulk_delete_analyses(queryset)
+    modeladmin.message_user(request, _("Successfully deleted %d analyses.") % count)
+    return None
 
 class AnalysisAdmin(admin.ModelAdmin):
-    pass
+    def get_actions(self, request):
+        actions = super(AnalysisAdmin, self).get_actions(request)
+        if 'delete_selected' in actions:
+            actions['delete_selected'] = (delete_selected_analyses, 'delete_selected',
+                                          delete_selected.short_description)
+        return actions
 
 class GeoMondrianRoleAdmin(admin.ModelAdmin):
     list_display = ('rolename',)
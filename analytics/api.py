@@ -0,0 +1,31 @@
+from geonode.api.resourcebase_api import CommonModelApi, CommonMetaApi
+
+from analytics.models import Analysis, AnalysisContent
+
+# Filters on the contents of the analyses, e.g. ?cube=Sales&chart=bar
+CONTENT_FILTERS = [kind for kind, name in AnalysisContent.KINDS]
+
+class AnalysisResource(CommonModelApi):
+    """ Class to be used in the search API of GeoNode """
+    class Meta(CommonMetaApi):
+        queryset = Analysis.objects.distinct().order_by('-date')
+        resource_name = 'analysis'
+
+    def build_filters(self, filters={}):
+        orm_filters = super(AnalysisResource, self).build_filters(filters)
+        contents = []
+        for kind in CONTENT_FILTERS:
+            if kind in filters:
+                values = filters.getlist(kind) if hasattr(filters, 'getlist') else [filters[kind]]
+                contents.extend((kind, value) for value in values)
+        if contents:
+            orm_filters['contents'] = contents
+        return orm_filters
+
+    def apply_filters(self, request, applicable_filters):
+        """ The analyses must have all the requested contents """
+        contents = applicable_filters.pop('contents', [])
+        filtered = super(AnalysisResource, self).apply_filters(request, applicable_filters)
+        for kind, value in contents:
+            filtered = filtered.filter(contents__kind=kind, contents__value=value)
+        return filtered
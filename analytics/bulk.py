@@ -0,0 +1,195 @@
+import datetime
+from uuid import uuid1
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import signals
+from django.contrib.staticfiles.templatetags import staticfiles
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from geonode.base.models import ResourceBase, ContactRole
+from geonode.security.models import ADMIN_PERMISSIONS
+
+from agon_ratings.models import OverallRating
+
+from analytics.models import Analysis, _bulk_delete
+from analytics.versions import bump_versions
+
+# Permissions granted to the anonymous group by set_default_permissions()
+_ANONYMOUS_PERMISSIONS = (
+    ('DEFAULT_ANONYMOUS_VIEW_PERMISSION', 'view_resourcebase'),
+    ('DEFAULT_ANONYMOUS_DOWNLOAD_PERMISSION', 'download_resourcebase'),
+)
+
+def bulk_create_analyses(analyses, batch_size=500, send_signals=True):
+    """
+    Save the given unsaved analyses with one insert per table and per batch
+    and give them the default permissions. This is the bulk equivalent of
+    calling save() then set_default_permissions() on each analysis, the
+    fields GeoNode fills after a save (see _set_missing_info) are set too.
+
+    Django can't bulk create multi-table inherited models, so the ResourceBase
+    rows are created first, their ids are fetched back through their uuid and
+    the Analysis rows are then inserted pointing to them. post_save signals are
+    sent once all the batches are saved if send_signals is True, the contents
+    of the analyses are only indexed by them.
+    Returns the list of the created analyses.
+    """
+    created = []
+    batch = []
+    for analysis in analyses:
+        batch.append(analysis)
+        if len(batch) >= batch_size:
+            created.extend(_create_batch(batch))
+            batch = []
+    if batch:
+        created.extend(_create_batch(batch))
+
+    if send_signals:
+        for analysis in created:
+            signals.post_save.send(sender=Analysis, instance=analysis, created=True,
+                                   raw=False, using=analysis._state.db, update_fields=None)
+
+    return created
+
+def _create_batch(batch):
+    """ Insert a batch of analyses and their permissions in one transaction """
+    using = router.db_for_write(Analysis)
+    analysis_ct = ContentType.objects.get_for_model(Analysis)
+    parent_fields = [f.attname for f in ResourceBase._meta.concrete_fields if not f.primary_key]
+
+    # New analyses have no thumbnail links, see ResourceBase.get_thumbnail_url
+    thumbnail_url = staticfiles.static(settings.MISSING_THUMBNAIL)
+    now = datetime.datetime.now()
+
+    with transaction.atomic(using=using):
+        for analysis in batch:
+            if not analysis.uuid:
+                analysis.uuid = str(uuid1())
+            analysis.polymorphic_ctype = analysis_ct
+            analysis.thumbnail_url = thumbnail_url
+            analysis.csw_insert_date = now
+
+        ResourceBase.objects.using(using).bulk_create([
+            ResourceBase(**dict((name, getattr(analysis, name)) for name in parent_fields))
+            for analysis in batch
+        ])
+
+        ids = dict(ResourceBase.objects.using(using).filter(
+            uuid__in=[analysis.uuid for analysis in batch]).values_list('uuid', 'id'))
+        for analysis in batch:
+            analysis.id = analysis.resourcebase_ptr_id = ids[analysis.uuid]
+            analysis._state.adding = False
+            analysis._state.db = using
+
+        Analysis._base_manager._insert(batch, fields=Analysis._meta.local_concrete_fields,
+                                     using=using)
+
+        _set_missing_info(batch, using)
+        bulk_set_default_permissions(batch)
+
+    return batch
+
+def _set_missing_info(resources, using):
+    """
+    Set the detail urls and the default contacts of saved resources, with one
+    batch of updates and one insert. This is the work of GeoNode's
+    resourcebase_post_save() on resources without links or contacts.
+    """
+    for resource in resources:
+        resource.detail_url = resource.get_absolute_url()
+    connection = connections[using]
+    connection.cursor().executemany('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+        connection.ops.quote_name(ResourceBase._meta.db_table),
+        connection.ops.quote_name('detail_url'),
+        connection.ops.quote_name('id'),
+    ), [(resource.detail_url, resource.id) for resource in resources])
+
+    admin = None
+    if any(resource.owner_id is None for resource in resources):
+        admin = ResourceBase.objects.admin_contact()
+    ContactRole.objects.using(using).bulk_create([
+        ContactRole(resource_id=resource.id, contact_id=resource.owner_id or admin.id, role=role)
+        for resource in resources
+        for role in ('pointOfContact', 'author')
+    ])
+
+def bulk_set_default_permissions(resources):
+    """
+    Give the default permissions to resources that don't have any user
+    permission yet, like ResourceBase.set_missing_info() does, with one query
+    for the existing permissions, one insert for the owners and one for the
+    anonymous group.
+    """
+    ct = ContentType.objects.get_for_model(ResourceBase)
+    perms = dict(Permission.objects.filter(
+        content_type=ct,
+        codename__in=ADMIN_PERMISSIONS).values_list('codename', 'id'))
+
+    existing = set(UserObjectPermission.objects.filter(
+        content_type=ct,
+        object_pk__in=[str(resource.id) for resource in resources]).values_list('object_pk', flat=True))
+    resources = [resource for resource in resources if str(resource.id) not in existing]
+    if not resources:
+        return
+
+    UserObjectPermission.objects.bulk_create([
+        UserObjectPermission(permission_id=perms[codename], content_type=ct,
+                             object_pk=str(resource.id), user_id=resource.owner_id)
+        for resource in resources
+        for codename in ADMIN_PERMISSIONS
+        if resource.owner_id is not None
+    ])
+
+    anonymous_perms = [codename for setting, codename in _ANONYMOUS_PERMISSIONS
+                       if getattr(settings, setting, False)]
+    if anonymous_perms:
+        anonymous_group, created = Group.objects.get_or_create(name='anonymous')
+        GroupObjectPermission.objects.bulk_create([
+            GroupObjectPermission(permission_id=perms[codename], content_type=ct,
+                                  object_pk=str(resource.id), group=anonymous_group)
+            for resource in resources
+            for codename in anonymous_perms
+        ])
+
+def bulk_delete_analyses(queryset):
+    """
+    Delete the analyses of the queryset in one transaction with set-based
+    queries: their ratings and permissions are deleted and the documents
+    related to them are unlinked. This does the work of pre_delete_analysis
+    and of the permission and document handlers without a query per
+    analysis. Returns the number of deleted analyses.
+    """
+    # Imported here so that loading the admin doesn't load the documents
+    from geonode.documents.models import Document
+
+    using = router.db_for_write(Analysis)
+    ids = list(queryset.values_list('id', flat=True))
+    if not ids:
+        return 0
+    object_pks = [str(id) for id in ids]
+    analysis_ct = ContentType.objects.get_for_model(Analysis)
+    resource_ct = ContentType.objects.get_for_model(ResourceBase)
+
+    _bulk_delete.active = True
+    try:
+        with transaction.atomic(using=using):
+            OverallRating.objects.filter(content_type=analysis_ct, object_id__in=ids).delete()
+            # The permissions have post_delete handlers, which would make
+            # delete() fetch and delete them one by one
+            UserObjectPermission.objects.filter(
+                content_type=resource_ct, object_pk__in=object_pks)._raw_delete(using)
+            GroupObjectPermission.objects.filter(
+                content_type=resource_ct, object_pk__in=object_pks)._raw_delete(using)
+            Document.objects.filter(content_type=analysis_ct, object_id__in=ids).update(
+                content_type=None, object_id=None)
+            Analysis.objects.filter(id__in=ids).delete()
+    finally:
+        _bulk_delete.active = False
+
+    bump_versions('analysis', ids)
+    bump_versions('permissions', object_pks)
+    return len(ids)
@@ -0,0 +1,160 @@
+"""
+Version history of the states of the analyses.
+
+Each save of a new state appends a version. A version is a checkpoint holding
+the whole state every ANALYSIS_HISTORY_CHECKPOINT_INTERVAL versions, or when
+the state drifted too far from the last checkpoint, and otherwise holds the
+differences of the state with the last checkpoint: the storage of a save is
+proportional to the changes, and a version is restored by applying a single
+set of differences to its checkpoint. Only the last ANALYSIS_HISTORY_RETENTION
+versions are kept, with the checkpoint the oldest of them depends on.
+
+The differences between two JSON values are:
+
+- {"=": value} when the value is replaced
+- {"k": {key: differences}, "-": [key, ...]} for the changed and the
+  removed keys of an object, new keys being replaced values
+- {"i": {index: differences}} for the changed items of an array of the
+  same length
+"""
+import json
+
+from django.conf import settings
+from django.db import transaction
+
+from analytics.models import Analysis, AnalysisVersion
+
+def diff(old, new):
+    """ Returns the differences turning old into new, None if they are equal """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key, value in new.items():
+            if key not in old:
+                changes[key] = {'=': value}
+            else:
+                differences = diff(old[key], value)
+                if differences is not None:
+                    changes[key] = differences
+        removed = [key for key in old if key not in new]
+        result = {}
+        if changes:
+            result['k'] = changes
+        if removed:
+            result['-'] = removed
+        return result or None
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        changes = {}
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            differences = diff(old_item, new_item)
+            if differences is not None:
+                changes[str(index)] = differences
+        return {'i': changes} if changes else None
+    # Compared by type too, as True == 1 and 1 == 1.0
+    if type(old) is type(new) and old == new:
+        return None
+    return {'=': new}
+
+def patch(old, differences):
+    """ Returns old with the differences computed by diff applied """
+    if '=' in differences:
+        return differences['=']
+    if 'i' in differences:
+        result = list(old)
+        for index, item_differences in differences['i'].items():
+            result[int(index)] = patch(result[int(index)], item_differences)
+        return result
+
+    result = dict(old)
+    for key in differences.get('-', ()):
+        del result[key]
+    for key, value_differences in differences.get('k', {}).items():
+        result[key] = patch(result.get(key), value_differences)
+    return result
+
+def _state(version, checkpoint):
+    """ Returns the state saved in a version, checkpoint is its checkpoint """
+    state = json.loads(checkpoint.data)
+    if version.is_checkpoint:
+        return state
+    return patch(state, json.loads(version.data))
+
+def _load(analysis, number):
+    """ Returns a version of an analysis and its checkpoint, raises AnalysisVersion.DoesNotExist """
+    version = AnalysisVersion.objects.get(analysis=analysis, number=number)
+    if version.is_checkpoint:
+        return version, version
+    return version, AnalysisVersion.objects.get(analysis=analysis, number=version.checkpoint)
+
+def get_state(analysis, number):
+    """ Returns the state of an analysis saved in a version, raises AnalysisVersion.DoesNotExist """
+    return _state(*_load(analysis, number))
+
+def record_version(analysis, user=None):
+    """
+    Append the current state of an analysis to its history, if it changed
+    since the last version. Returns the new version or None.
+    """
+    with transaction.atomic():
+        # Lock the analysis so that concurrent saves get consecutive numbers
+        list(Analysis.objects.select_for_update().filter(id=analysis.id).values_list('id'))
+
+        state = json.loads(analysis.data)
+        latest = AnalysisVersion.objects.filter(analysis=analysis).order_by('-number').first()
+        if latest is None:
+            number, checkpoint, data = 1, 1, analysis.data
+        else:
+            latest_checkpoint = latest if latest.is_checkpoint else AnalysisVersion.objects.get(
+                analysis=analysis, number=latest.checkpoint)
+            if diff(_state(latest, latest_checkpoint), state) is None:
+                return None
+
+            number = latest.number + 1
+            differences = json.dumps(diff(json.loads(latest_checkpoint.data), state))
+            if (number - latest_checkpoint.number >= settings.ANALYSIS_HISTORY_CHECKPOINT_INTERVAL
+                    or len(differences) * 2 > len(analysis.data)):
+                checkpoint, data = number, analysis.data
+            else:
+                checkpoint, data = latest_checkpoint.number, differences
+
+        version = AnalysisVersion.objects.create(analysis=analysis, number=number, checkpoint=checkpoint,
+                                                 data=data, user=user if user and user.is_authenticated() else None)
+        _apply_retention(analysis, number)
+    return version
+
+def record_stored_version(analysis):
+    """
+    Record the state stored in the database of an analysis without history,
+    e.g. saved before the history existed, as its first version so that it
+    can be restored after a new state is saved. Call it before saving.
+    """
+    with transaction.atomic():
+        stored = Analysis.objects.select_for_update().filter(id=analysis.id).values_list('data', flat=True)
+        if not stored or AnalysisVersion.objects.filter(analysis=analysis).exists():
+            return
+        try:
+            json.loads(stored[0])
+        except (TypeError, ValueError):
+            # Not a state of the viewer, it can't be restored
+            return
+        AnalysisVersion.objects.create(analysis=analysis, number=1, checkpoint=1, data=stored[0])
+
+def _apply_retention(analysis, latest):
+    """ Delete the versions older than the retention, except the checkpoint of the oldest kept version """
+    retention = settings.ANALYSIS_HISTORY_RETENTION
+    if not retention or latest <= retention:
+        return
+    oldest = latest - retention + 1
+    versions = AnalysisVersion.objects.filter(analysis=analysis)
+    checkpoint = versions.filter(number=oldest).values_list('checkpoint', flat=True).first() or oldest
+    versions.filter(number__lt=oldest).exclude(number=checkpoint).delete()
+
+def restore_version(analysis, number, user=None):
+    """
+    Restore the state of an analysis saved in a version, the restored state is
+    appended to the history. Raises AnalysisVersion.DoesNotExist.
+    """
+    analysis.data = json.dumps(get_state(analysis, number))
+    with transaction.atomic():
+        analysis.save()
+        record_version(analysis, user)
+    return analysis.data
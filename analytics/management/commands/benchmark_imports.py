@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import subprocess
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules imported when a worker starts and serves its first requests
+DEFAULT_MODULES = (
+    'analytics.settings',
+    'analytics.models',
+    'analytics.mandoline',
+    'analytics.views',
+    'analytics.admin',
+    'analytics.urls',
+    'analytics.wsgi',
+)
+
+# Imports a module in a fresh interpreter and prints its import time and the
+# memory it added to the process (ru_maxrss is in kilobytes on Linux)
+_PROBE = """
+import sys, time, resource
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+__import__(sys.argv[1])
+print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+"""
+
+class Command(BaseCommand):
+    """
+    Measure the cold import time and memory of the modules of the app, each
+    one in a fresh interpreter, including the modules they import. With a
+    baseline file the command fails if a module got slower or bigger than the
+    baseline by more than the tolerance.
+    """
+    help = 'Benchmark the import time and memory of the analytics modules.'
+    args = '[module ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=3,
+                    help='Number of measures per module, the best one is kept.'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='JSON file with the reference measures.'),
+        make_option('--save', action='store_true', dest='save', default=False,
+                    help='Write the measures to the baseline file instead of comparing them.'),
+        make_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                    help='Allowed relative regression compared to the baseline.'),
+    )
+
+    def handle(self, *modules, **options):
+        results = {}
+        for module in modules or DEFAULT_MODULES:
+            results[module] = self._measure(module, options['repeat'])
+            self.stdout.write('%-30s %8.1f ms %8d KB' % (module, results[module]['time'] * 1000,
+                                                         results[module]['rss']))
+
+        if not options['baseline']:
+            return
+        if options['save']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            return
+
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        regressions = []
+        for module, result in sorted(results.items()):
+            if module not in baseline:
+                continue
+            for measure in ('time', 'rss'):
+                if result[measure] > baseline[module][measure] * (1 + options['tolerance']):
+                    regressions.append('%s %s: %s > %s' % (module, measure, result[measure],
+                                                           baseline[module][measure]))
+        if regressions:
+            raise CommandError('Import regressions:\n' + '\n'.join(regressions))
+
+    def _measure(self, module, repeat):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'analytics.settings'))
+        measures = []
+        for i in range(repeat):
+            process = subprocess.Popen([sys.executable, '-c', _PROBE, module], env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            if process.returncode:
+                raise CommandError('Could not import %s:\n%s' % (module, err))
+            seconds, rss = out.split()[-2:]
+            measures.append((float(seconds), int(rss)))
+        return {'time': min(m[0] for m in measures), 'rss': min(m[1] for m in measures)}
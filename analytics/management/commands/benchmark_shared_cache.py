@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import random
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.mandoline.shmcache import SharedCache
+
+class Command(BaseCommand):
+    """
+    Measure the latency of the reads and writes of the shared Mandoline cache
+    with several processes using it at once, on a temporary cache file. Each
+    process reads random keys and writes a fraction of them for the duration
+    of the run, and the command prints the throughput and the percentiles of
+    the latencies for each number of processes.
+    """
+    help = 'Benchmark the shared Mandoline cache under concurrency.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', default='1,4,8',
+                    help='Comma separated numbers of concurrent processes to measure.'),
+        make_option('--duration', dest='duration', type='float', default=2,
+                    help='Duration of each run in seconds.'),
+        make_option('--keys', dest='keys', type='int', default=1000,
+                    help='Number of distinct keys.'),
+        make_option('--value-size', dest='value_size', type='int', default=8192,
+                    help='Size of the values in bytes.'),
+        make_option('--writes', dest='writes', type='float', default=0.01,
+                    help='Fraction of the operations that are writes.'),
+        make_option('--dir', dest='dir', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                    help='Directory of the temporary cache file.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(count) for count in options['processes'].split(',')]
+        except ValueError:
+            raise CommandError('--processes must be comma separated numbers')
+
+        keys = options['keys']
+        size = keys * (options['value_size'] + 64) * 2
+        fd, path = tempfile.mkstemp(prefix='analytics-shmcache-', dir=options['dir'])
+        os.close(fd)
+        try:
+            cache = SharedCache(path, size, keys * 2)
+            value = 'x' * options['value_size']
+            for key in range(keys):
+                cache.set('key %d' % key, value)
+
+            self.stdout.write('%9s %12s %10s %10s %10s %10s' % (
+                'processes', 'ops/s', 'get p50', 'get p99', 'set p50', 'set p99'))
+            for count in counts:
+                gets, sets = self._run(cache, count, options['duration'], keys, value, options['writes'])
+                self.stdout.write('%9d %12d %8.1fus %8.1fus %8.1fus %8.1fus' % (
+                    count, (len(gets) + len(sets)) / options['duration'],
+                    _percentile(gets, 0.5), _percentile(gets, 0.99),
+                    _percentile(sets, 0.5), _percentile(sets, 0.99)))
+        finally:
+            os.remove(path)
+
+    def _run(self, cache, count, duration, keys, value, writes):
+        """ Returns the latencies in microseconds of the gets and of the sets of count processes """
+        children = []
+        for i in range(count):
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read)
+                try:
+                    result = json.dumps(_work(cache, duration, keys, value, writes))
+                    with os.fdopen(write, 'w') as f:
+                        f.write(result)
+                finally:
+                    os._exit(0)
+            os.close(write)
+            children.append((pid, read))
+
+        gets, sets = [], []
+        for pid, read in children:
+            with os.fdopen(read) as f:
+                result = f.read()
+            os.waitpid(pid, 0)
+            if not result:
+                raise CommandError('A benchmark process failed')
+            result = json.loads(result)
+            gets.extend(result['gets'])
+            sets.extend(result['sets'])
+        return gets, sets
+
+def _work(cache, duration, keys, value, writes):
+    gets, sets = [], []
+    end = time.time() + duration
+    while time.time() < end:
+        key = 'key %d' % random.randrange(keys)
+        if random.random() < writes:
+            start = time.time()
+            cache.set(key, value)
+            sets.append((time.time() - start) * 1e6)
+        else:
+            start = time.time()
+            cache.get(key)
+            gets.append((time.time() - start) * 1e6)
+    return {'gets': gets, 'sets': sets}
+
+def _percentile(latencies, fraction):
+    if not latencies:
+        return 0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
@@ -0,0 +1,57 @@
+import sys
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from analytics.models import Analysis
+
+class Command(BaseCommand):
+    """
+    Export analyses to a NDJSON file, one analysis per line, their data being
+    the text stored in the database. The output can be loaded back with the
+    import_analyses command.
+    """
+    help = 'Export analyses to a NDJSON file ("-" for the standard output).'
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--owner', dest='owner', default=None,
+                    help='Only export the analyses of this user.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of analyses fetched per query.'),
+    )
+
+    def handle(self, path='-', **options):
+        queryset = Analysis.objects.order_by('id')
+        if options['owner']:
+            queryset = queryset.filter(owner__username=options['owner'])
+
+        stream = sys.stdout if path == '-' else open(path, 'w')
+        count = 0
+        try:
+            for row in _iter_rows(queryset, options['batch_size']):
+                stream.write(json.dumps(row) + '\n')
+                count += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        if stream is not sys.stdout:
+            self.stdout.write('%d analyses exported' % count)
+
+def _iter_rows(queryset, batch_size):
+    """
+    Yield the analyses of the queryset as dicts, fetching them by batches of
+    ids so that the whole table is never loaded in memory.
+    """
+    queryset = queryset.values_list('id', 'title', 'abstract', 'data', 'owner__username')
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        for id, title, abstract, data, owner in batch:
+            # The data is exported as stored, it is imported back verbatim
+            yield {'title': title, 'abstract': abstract, 'data': data, 'owner': owner}
+        last_id = batch[-1][0]
@@ -0,0 +1,80 @@
+import sys
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+
+from analytics.models import Analysis
+from analytics.bulk import bulk_create_analyses
+
+class Command(BaseCommand):
+    """
+    Import analyses from a NDJSON file, one analysis per line:
+    {"title": ..., "abstract": ..., "data": "...", "owner": "username"}
+    This is the format written by the export_analyses command, data is the
+    text stored as is. A JSON object is also accepted as data.
+
+    By default each imported analysis gets the post_save signals of a save(),
+    GeoNode then makes several queries per analysis (links, contact roles,
+    URLs). With --no-signals the import only makes a few queries and one
+    batch of updates per batch of analyses, which get the same detail urls,
+    contacts and permissions, but their contents must then be indexed with
+    index_analyses.
+    """
+    help = 'Import analyses from a NDJSON file ("-" for the standard input).'
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--owner', dest='owner', default=None,
+                    help='Username of the owner of the analyses without an owner.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of analyses inserted per query.'),
+        make_option('--no-signals', action='store_false', dest='send_signals', default=True,
+                    help="Don't send the post_save signals of the imported analyses, much faster "
+                         "(run index_analyses afterwards)."),
+    )
+
+    def handle(self, path='-', **options):
+        self._owners = {}
+        self._default_owner = options['owner']
+
+        stream = sys.stdin if path == '-' else open(path)
+        start = time.time()
+        try:
+            created = bulk_create_analyses(self._read(stream), batch_size=options['batch_size'],
+                                           send_signals=options['send_signals'])
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        duration = time.time() - start
+        self.stdout.write('%d analyses imported in %.1fs (%.0f analyses/s)' % (
+            len(created), duration, len(created) / duration if duration else 0))
+
+    def _read(self, stream):
+        """ Yield an unsaved analysis for each line of the stream """
+        for lineno, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                yield Analysis(
+                    owner=self._owner(row.get('owner') or self._default_owner),
+                    title=row['title'],
+                    abstract=row['abstract'],
+                    data=row['data'] if isinstance(row['data'], basestring) else json.dumps(row['data']))
+            except (ValueError, KeyError), e:
+                raise CommandError('Invalid analysis on line %d: %s' % (lineno, e))
+
+    def _owner(self, username):
+        """ Get the user with the given username, users are fetched only once """
+        if username is None:
+            raise CommandError('No owner given, use --owner to set a default one')
+        if username not in self._owners:
+            try:
+                self._owners[username] = get_user_model().objects.get(username=username)
+            except get_user_model().DoesNotExist:
+                raise CommandError('Unknown owner "%s"' % username)
+        return self._owners[username]
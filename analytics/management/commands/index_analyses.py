@@ -0,0 +1,53 @@
+import operator
+from optparse import make_option
+
+from django.db import transaction
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+
+from analytics.models import Analysis, AnalysisContent, analysis_contents
+
+class Command(BaseCommand):
+    """
+    Build or update the index of the contents of the analyses, for the
+    analyses saved before it existed or imported without signals. Only the
+    differences with the current index are written, with one delete and one
+    insert per batch.
+    """
+    help = 'Index the cubes, measures, hierarchies and chart types of the analyses.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of analyses indexed per transaction.'),
+    )
+
+    def handle(self, **options):
+        queryset = Analysis.objects.order_by('id').values_list('id', 'data')
+        count = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            indexed = dict((id, set()) for id, data in batch)
+            for id, kind, value in AnalysisContent.objects.filter(analysis__in=list(indexed)).values_list(
+                    'analysis', 'kind', 'value'):
+                indexed[id].add((kind, value))
+
+            added = []
+            removed = []
+            for id, data in batch:
+                contents = analysis_contents(data)
+                added.extend(AnalysisContent(analysis_id=id, kind=kind, value=value)
+                             for kind, value in contents - indexed[id])
+                removed.extend(Q(analysis=id, kind=kind, value=value)
+                               for kind, value in indexed[id] - contents)
+
+            with transaction.atomic():
+                if removed:
+                    AnalysisContent.objects.filter(reduce(operator.or_, removed)).delete()
+                AnalysisContent.objects.bulk_create(added)
+            count += len(batch)
+            last_id = batch[-1][0]
+
+        self.stdout.write('%d analyses indexed' % count)
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+
+from analytics.mandoline import generations
+
+class Command(BaseCommand):
+    """
+    Invalidate the cached Mandoline replies on cubes changed by the ETL, to
+    be run after a load. The replies on the other cubes stay cached.
+    """
+    help = 'Invalidate the cached Mandoline replies on some cubes or hierarchies.'
+    args = '[cube ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--hierarchy', action='append', dest='hierarchies', default=[],
+                    help='Only invalidate the replies depending on the members of this hierarchy of the cube.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Invalidate the replies on all the cubes.'),
+    )
+
+    def handle(self, *cubes, **options):
+        if options['all']:
+            generations.invalidate()
+            return
+        if not cubes:
+            raise CommandError('Give the cubes to invalidate or --all.')
+        if options['hierarchies'] and len(cubes) > 1:
+            raise CommandError('--hierarchy needs a single cube.')
+
+        hierarchies = [force_text(hierarchy) for hierarchy in options['hierarchies']]
+        for cube in cubes:
+            generations.invalidate(force_text(cube), hierarchies)
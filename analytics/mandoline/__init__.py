@@ -0,0 +1,134 @@
+"""
+Proxy to the Mandoline OLAP server used by the mandoline_api view.
+
+Replies are cached in each process when MANDOLINE_CACHE_SIZE is set, or once
+for all the processes of the host with MANDOLINE_SHARED_CACHE (see
+shmcache.py). With MANDOLINE_QUERY_PLANNER data queries are answered from
+cached results of finer queries when possible (see planner.py). The queries actually sent to
+Mandoline go through the admission control (see admission.py) and are spread
+over the Mandoline servers (see backends.py). The "members" queries, paginated
+and searchable lists of members, are answered by the proxy (see members.py).
+The cached replies requested again are kept compressed (see compression.py).
+The ETL invalidates the cached replies on the cubes it changes (see
+generations.py). The cache, the servers and the planner are set up on the
+first query of the process, not when the module is imported.
+"""
+import json
+import threading
+
+from django.conf import settings
+
+from analytics.mandoline import admission, compression, generations, members
+from analytics.mandoline.backends import BackendPool
+from analytics.mandoline.cache import LRUCache
+from analytics.mandoline.planner import QueryPlanner, canonical
+from analytics.mandoline.shmcache import SharedCache
+
+_lock = threading.Lock()
+_proxy = None
+
+class _Proxy(object):
+    """ The reply cache, the Mandoline servers and the query planner of the process """
+
+    def __init__(self):
+        self.cache = None
+        if settings.MANDOLINE_SHARED_CACHE:
+            self.cache = SharedCache(settings.MANDOLINE_SHARED_CACHE['PATH'], settings.MANDOLINE_SHARED_CACHE['SIZE'],
+                                     settings.MANDOLINE_SHARED_CACHE['SLOTS'])
+        elif settings.MANDOLINE_CACHE_SIZE:
+            self.cache = LRUCache(settings.MANDOLINE_CACHE_SIZE)
+
+        self.pool = BackendPool.from_settings()
+
+        self.planner = None
+        if self.cache is not None and settings.MANDOLINE_QUERY_PLANNER:
+            self.planner = QueryPlanner(self.cache, settings.MANDOLINE_ADDITIVE_MEASURES, generations.generation)
+
+def _get_proxy():
+    """ Returns the _Proxy of the process, set up on first use """
+    global _proxy
+    if _proxy is None:
+        with _lock:
+            if _proxy is None:
+                _proxy = _Proxy()
+    return _proxy
+
+def fetch(request_json, requester):
+    """ Send the query to Mandoline on behalf of requester and return its reply """
+    with admission.admit(request_json.get('role'), requester):
+        return _get_proxy().pool.send(request_json)
+
+def _key(request_json):
+    """ Returns the cache key of the reply to a query, in the current generation of the data """
+    return '%s\n%s' % (canonical(request_json), generations.query_generation(request_json))
+
+def query(request_json, requester):
+    """
+    Returns the reply to a query, from the cache if possible. requester
+    identifies the user for the admission control. Raises admission.Rejected
+    if the query is shed and socket.error if Mandoline is unreachable.
+    """
+    with generations.memoized():
+        if request_json.get('queryType') == 'members':
+            return members.query(request_json, lambda q: fetch(q, requester))
+
+        cache = _get_proxy().cache
+        if cache is None:
+            return fetch(request_json, requester)
+
+        key = _key(request_json)
+        reply = cache.get(key)
+        if reply is not None:
+            return reply
+        return _query(request_json, requester, key)
+
+def _query(request_json, requester, key):
+    """ Returns the reply to a query missing from the cache, and caches it """
+    proxy = _get_proxy()
+    reply = None
+    if proxy.planner is not None:
+        reply = proxy.planner.answer(request_json, lambda q: fetch(q, requester))
+    if reply is None:
+        reply = fetch(request_json, requester)
+
+    try:
+        reply_json = json.loads(reply)
+    except ValueError:
+        return reply
+    if reply_json.get('error') == 'OK':
+        proxy.cache.set(key, reply)
+        if proxy.planner is not None:
+            proxy.planner.record(key, request_json, reply_json)
+
+    return reply
+
+def encoded_query(request_json, requester, accept_encoding):
+    """
+    Returns the reply to a query and its content encoding, None if it is not
+    compressed. accept_encoding is the Accept-Encoding header of the client,
+    the reply is compressed if it is cached and requested again.
+    """
+    encoding = compression.negotiate(accept_encoding)
+    cache = _get_proxy().cache
+    if cache is None or encoding is None or request_json.get('queryType') == 'members':
+        return query(request_json, requester), None
+
+    with generations.memoized():
+        key = _key(request_json)
+        variant_key = compression.variant_key(key, encoding)
+        body = cache.get(variant_key)
+        if body:
+            return body, encoding
+
+        reply = cache.get(key)
+        if reply is None:
+            return _query(request_json, requester, key), None
+        if body is None:
+            # An empty variant marks the replies not worth compressing
+            body = compression.compress(reply, encoding) or ''
+            cache.set(variant_key, body)
+        return (body, encoding) if body else (reply, None)
+
+def stats():
+    """ Returns the metrics of the admission control and of the servers in this process """
+    return dict(admission.stats(), backends=_get_proxy().pool.stats())
@@ -0,0 +1,286 @@
+"""
+Admission control of the queries sent to Mandoline.
+
+The number of queries in flight per user and per GeoMondrian role is limited
+for all the worker processes of the host (see SharedLimiter), queries over
+the limits wait in a bounded queue of their process and are shed when it is
+full or when they waited too long. Each Mandoline server has a circuit
+breaker, in each process, that stops sending it queries for a while when it
+keeps failing.
+"""
+import os
+import math
+import time
+import errno
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class Rejected(Exception):
+    """ Raised when a query is not sent to Mandoline """
+
+    def __init__(self, reason, retry_after):
+        super(Rejected, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = int(math.ceil(retry_after))
+
+class Limiter(object):
+    """ Counts the queries in flight per key, making the others wait in a bounded queue """
+
+    def __init__(self, queue_size, timeout):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = {}
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _available(self, limits):
+        return all(limit is None or self.in_flight.get(key, 0) < limit for key, limit in limits)
+
+    def acquire(self, limits):
+        """ Wait for a slot for each of the (key, limit) pairs, raises Rejected on failure """
+        with self._condition:
+            if not self._available(limits):
+                if self.waiting >= self.queue_size:
+                    raise Rejected('queue_full', 1)
+
+                self.waiting += 1
+                try:
+                    deadline = time.time() + self.timeout
+                    while not self._available(limits):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Rejected('wait_timeout', 1)
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            for key, limit in limits:
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def release(self, limits):
+        with self._condition:
+            for key, limit in limits:
+                self.in_flight[key] -= 1
+                if not self.in_flight[key]:
+                    del self.in_flight[key]
+            self._condition.notify_all()
+
+# Slots per key of SharedLimiter, the limits above are capped to it
+_MAX_SLOTS = 1 << 16
+# Seconds between two polls of the slots by a waiting query, at most
+_MAX_POLL_DELAY = 0.1
+
+class SharedLimiter(Limiter):
+    """
+    Limiter counting the queries in flight of all the processes of the host.
+
+    A query in flight holds one of the `limit` slots of each of its keys, a
+    slot being a byte of the file at path locked with fcntl. The locks are
+    seen by all the processes and released by the kernel when a process
+    dies, so a crashed worker doesn't leak its slots. The bytes are at
+    offsets derived from the keys, beyond the end of the file which stays
+    empty. The locks belong to the process, so its threads share the slots
+    they hold. The queue is per process, the queries in it poll the slots.
+    in_flight only counts the queries of the process.
+    """
+
+    def __init__(self, path, queue_size, timeout):
+        super(SharedLimiter, self).__init__(queue_size, timeout)
+        self.path = path
+        self._pid = None
+
+    def _open(self):
+        """ Open the file once per process, the locks of the parent are not inherited """
+        if self._pid == os.getpid():
+            return
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        self._held = {}
+        self.in_flight = {}
+        self._pid = os.getpid()
+
+    def _lock_slot(self, key, limit):
+        """ Returns True if a slot of key not held by the process could be locked """
+        held = self._held.setdefault(key, set())
+        offset = _offset(key)
+        for index in range(min(limit, _MAX_SLOTS)):
+            if index in held:
+                continue
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset + index)
+            except IOError, e:
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    continue
+                raise
+            held.add(index)
+            return True
+        return False
+
+    def _unlock_slot(self, key):
+        held = self._held[key]
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _offset(key) + held.pop())
+        if not held:
+            del self._held[key]
+
+    def _try_acquire(self, limits):
+        with self._condition:
+            self._open()
+            locked = []
+            for key, limit in limits:
+                if limit is None:
+                    continue
+                if not self._lock_slot(key, limit):
+                    for locked_key in locked:
+                        self._unlock_slot(locked_key)
+                    return False
+                locked.append(key)
+
+            for key, limit in limits:
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+            return True
+
+    def acquire(self, limits):
+        """ Wait for a slot for each of the (key, limit) pairs, raises Rejected on failure """
+        if self._try_acquire(limits):
+            return
+
+        with self._condition:
+            if self.waiting >= self.queue_size:
+                raise Rejected('queue_full', 1)
+            self.waiting += 1
+        try:
+            deadline = time.time() + self.timeout
+            delay = 0.005
+            while not self._try_acquire(limits):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Rejected('wait_timeout', 1)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, _MAX_POLL_DELAY)
+        finally:
+            with self._condition:
+                self.waiting -= 1
+
+    def release(self, limits):
+        with self._condition:
+            for key, limit in limits:
+                if limit is not None:
+                    self._unlock_slot(key)
+                self.in_flight[key] -= 1
+                if not self.in_flight[key]:
+                    del self.in_flight[key]
+
+def _offset(key):
+    """ Returns the offset of the first slot of key, 40 bits of hash leave room for _MAX_SLOTS """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] >> 24) * _MAX_SLOTS
+
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures: queries are then rejected
+    until reset_timeout seconds have passed. A single trial query is then let
+    through, its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial else 'open'
+
+    def before(self):
+        """ Raises Rejected if the query can't be sent """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining > 0:
+                raise Rejected('circuit_open', remaining)
+            if self._trial:
+                raise Rejected('circuit_open', self.reset_timeout)
+            self._trial = True
+
+    def cancel(self):
+        """ The query allowed by before() was not sent """
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.max_failures:
+                if self.opened_at is None or self._trial:
+                    logger.warning('Mandoline circuit breaker opened after %d failures', self.failures)
+                self.opened_at = time.time()
+                self._trial = False
+
+_settings = settings.MANDOLINE_ADMISSION
+if _settings.get('SHARED_PATH'):
+    _limiter = SharedLimiter(_settings['SHARED_PATH'], _settings['QUEUE_SIZE'], _settings['QUEUE_TIMEOUT'])
+else:
+    _limiter = Limiter(_settings['QUEUE_SIZE'], _settings['QUEUE_TIMEOUT'])
+
+_shed = {}
+_shed_lock = threading.Lock()
+
+def _limits(role, requester):
+    role_limit = _settings['ROLE_LIMITS'].get(role, _settings['ROLE_LIMIT'])
+    return [('user:%s' % requester, _settings['USER_LIMIT']), ('role:%s' % role, role_limit)]
+
+@contextmanager
+def admit(role, requester):
+    """
+    Context manager wrapping a query sent to Mandoline on behalf of requester
+    (a user id or an IP address). Raises Rejected if the query is shed, the
+    Rejected exceptions raised inside it are counted as shed queries too.
+    """
+    limits = _limits(role, requester)
+    try:
+        _limiter.acquire(limits)
+    except Rejected, e:
+        _count_shed(e)
+        raise
+
+    try:
+        yield
+    except Rejected, e:
+        _count_shed(e)
+        raise
+    finally:
+        _limiter.release(limits)
+
+def _count_shed(rejected):
+    with _shed_lock:
+        _shed[rejected.reason] = _shed.get(rejected.reason, 0) + 1
+
+def stats():
+    """ Returns the admission control metrics of this process """
+    with _shed_lock:
+        shed = dict(_shed)
+    return {
+        'shed': shed,
+        'in_flight': dict(_limiter.in_flight),
+        'waiting': _limiter.waiting,
+    }
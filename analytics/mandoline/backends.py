@@ -0,0 +1,270 @@
+"""
+Pool of the Mandoline servers the queries are spread over.
+
+Queries go to the healthy server with the least outstanding queries relative
+to its weight, or with MANDOLINE_ROUTING = 'cube' to the server the cube is
+mapped to on a consistent hash ring, so that each server caches a subset of
+the cubes. Each server has its own circuit breaker and is checked in the
+background every MANDOLINE_HEALTH_CHECK_INTERVAL seconds.
+
+A query failing with a socket error or a timeout is sent once more to the
+next server. With MANDOLINE_HEDGING, a query still running after the 95th
+percentile of the latencies of its server is sent to a second server as
+well, the first reply is used and the other query is cancelled.
+"""
+import os
+import json
+import time
+import Queue
+import random
+import socket
+import bisect
+import hashlib
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from analytics.mandoline import client
+from analytics.mandoline.admission import CircuitBreaker, Rejected
+
+logger = logging.getLogger(__name__)
+
+# Number of latencies kept per server to compute its 95th percentile
+_LATENCY_SAMPLES = 200
+# Minimal number of latencies before hedging queries to a server
+_MIN_SAMPLES = 20
+# Points of a server of weight 1 on the hash ring
+_RING_POINTS = 100
+
+class Backend(object):
+    """ A Mandoline server """
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.outstanding = 0
+        self.healthy = True
+        self.breaker = CircuitBreaker(settings.MANDOLINE_ADMISSION['FAILURES'],
+                                      settings.MANDOLINE_ADMISSION['RESET_TIMEOUT'])
+        self._latencies = deque(maxlen=_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def p95(self):
+        """ Returns the 95th percentile of the recent latencies or None if there are too few """
+        with self._lock:
+            if len(self._latencies) < _MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def send(self, querystr, timeout=None, cancellation=None):
+        """ Send a query to this server, see client.send """
+        with self._lock:
+            self.outstanding += 1
+        start = time.time()
+        try:
+            reply = client.send(querystr, self.host, self.port, timeout, cancellation)
+        except socket.error:
+            self.breaker.failure()
+            raise
+        except:
+            self.breaker.cancel()
+            raise
+        finally:
+            with self._lock:
+                self.outstanding -= 1
+
+        self.breaker.success()
+        with self._lock:
+            self._latencies.append(time.time() - start)
+        return reply
+
+    def stats(self):
+        return {
+            'backend': str(self),
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'circuit': self.breaker.state,
+            'p95': self.p95(),
+        }
+
+class BackendPool(object):
+    """ Routes the queries to the Mandoline servers """
+
+    def __init__(self, backends, routing='least-outstanding', hedging=False, health_check_interval=0):
+        self.backends = backends
+        self.routing = routing
+        self.hedging = hedging
+        self.health_check_interval = health_check_interval
+        self._ring = []
+        for backend in backends:
+            for i in range(int(_RING_POINTS * backend.weight)):
+                self._ring.append((_hash('%s#%d' % (backend, i)), backend))
+        self._ring.sort(key=lambda point: point[0])
+        self._ring_hashes = [h for h, backend in self._ring]
+        self._health_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        backends = settings.MANDOLINE_BACKENDS or [
+            {'HOST': settings.MANDOLINE_HOST, 'PORT': settings.MANDOLINE_PORT}]
+        return cls([Backend(b['HOST'], b['PORT'], b.get('WEIGHT', 1)) for b in backends],
+                   routing=settings.MANDOLINE_ROUTING,
+                   hedging=settings.MANDOLINE_HEDGING,
+                   health_check_interval=settings.MANDOLINE_HEALTH_CHECK_INTERVAL)
+
+    def send(self, request_json):
+        """
+        Send a query to a Mandoline server and return its reply. Raises
+        Rejected if the circuits of all the servers are open.
+        """
+        self._start_health_checks()
+        querystr = json.dumps(request_json)
+        candidates = self.candidates(request_json)
+        primary = self._acquire(candidates)
+        others = [b for b in candidates if b is not primary]
+
+        p95 = primary.p95() if self.hedging and others else None
+        if p95 is None:
+            try:
+                return primary.send(querystr)
+            except socket.error, e:
+                return self._retry(others, querystr, e)
+
+        replies = Queue.Queue()
+        cancellations = [_send_async(primary, querystr, replies)]
+        try:
+            ok, value = replies.get(timeout=p95)
+        except Queue.Empty:
+            try:
+                cancellations.append(_send_async(self._acquire(others), querystr, replies))
+            except Rejected:
+                pass
+            ok, value = replies.get()
+            pending = len(cancellations) - 1
+            while not ok and pending:
+                ok, value = replies.get()
+                pending -= 1
+            # The slower query would keep its thread and connection busy
+            for cancellation in cancellations:
+                cancellation.cancel()
+        else:
+            if not ok and isinstance(value, socket.error):
+                return self._retry(others, querystr, value)
+
+        if not ok:
+            raise value
+        return value
+
+    def _retry(self, backends, querystr, error):
+        """ Send a query that failed with error to the first of backends whose circuit lets it through, or raise error """
+        try:
+            backend = self._acquire(backends)
+        except Rejected:
+            raise error
+        return backend.send(querystr)
+
+    def candidates(self, request_json):
+        """ Returns the healthy servers by order of preference for a query """
+        healthy = [b for b in self.backends if b.healthy] or self.backends
+        cube = _cube(request_json)
+
+        if self.routing == 'cube' and cube is not None:
+            start = bisect.bisect(self._ring_hashes, _hash(cube))
+            ordered = []
+            for i in range(len(self._ring)):
+                backend = self._ring[(start + i) % len(self._ring)][1]
+                if backend in healthy and backend not in ordered:
+                    ordered.append(backend)
+                    if len(ordered) == len(healthy):
+                        break
+            return ordered
+
+        # Ties, such as idle servers, are broken at random in proportion to the
+        # weights: the first of the keys u ** (1 / weight) of uniform u
+        return sorted(healthy, key=lambda b: (float(b.outstanding) / b.weight,
+                                              -random.random() ** (1.0 / b.weight)))
+
+    def _acquire(self, backends):
+        """ Returns the first server whose circuit lets a query through """
+        retry_after = None
+        for backend in backends:
+            try:
+                backend.breaker.before()
+                return backend
+            except Rejected, e:
+                retry_after = e.retry_after if retry_after is None else min(retry_after, e.retry_after)
+        raise Rejected('circuit_open', retry_after or 1)
+
+    def _start_health_checks(self):
+        """ Start the health checks thread of this process if needed """
+        if not self.health_check_interval or self._health_pid == os.getpid():
+            return
+        with self._lock:
+            if self._health_pid == os.getpid():
+                return
+            self._health_pid = os.getpid()
+            thread = threading.Thread(target=self._check_health, name='mandoline-health-checks')
+            thread.daemon = True
+            thread.start()
+
+    def _check_health(self):
+        query = {'queryType': 'metadata', 'data': {'root': []}}
+        if settings.ROLES_ENABLED:
+            query['role'] = settings.ANONYMOUS_GEOMONDRIAN_ROLE
+        querystr = json.dumps(query)
+
+        while True:
+            for backend in self.backends:
+                try:
+                    reply = json.loads(client.send(querystr, backend.host, backend.port,
+                                                   settings.MANDOLINE_CONNECT_TIMEOUT))
+                    healthy = reply.get('error') == 'OK'
+                except (socket.error, ValueError):
+                    healthy = False
+                if healthy != backend.healthy:
+                    logger.warning('Mandoline server %s is %s', backend, 'up' if healthy else 'down')
+                backend.healthy = healthy
+            time.sleep(self.health_check_interval)
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+def _send_async(backend, querystr, replies):
+    """
+    Send a query in a thread, putting (True, reply) or (False, exception) in
+    replies. Returns the client.Cancellation of the query.
+    """
+    cancellation = client.Cancellation()
+    def run():
+        try:
+            replies.put((True, backend.send(querystr, cancellation=cancellation)))
+        except Exception, e:
+            replies.put((False, e))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return cancellation
+
+def _hash(key):
+    return int(hashlib.md5(unicode(key).encode('utf-8')).hexdigest()[:8], 16)
+
+def _cube(request_json):
+    """ Returns the cube of a query, if any """
+    data = request_json.get('data')
+    if not isinstance(data, dict):
+        return None
+    if request_json.get('queryType') == 'data':
+        return data.get('from')
+    root = data.get('root')
+    if isinstance(root, list) and len(root) > 1:
+        return root[1]
+    return None
@@ -0,0 +1,66 @@
+import socket
+import threading
+
+from django.conf import settings
+
+from analytics.profiling import phase
+
+class Cancelled(Exception):
+    """ Raised by send when its query was cancelled """
+
+class Cancellation(object):
+    """ Lets a thread cancel a query sent by another one, closing its connection """
+
+    def __init__(self):
+        self.cancelled = False
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def _attach(self, s):
+        with self._lock:
+            if self.cancelled:
+                raise Cancelled()
+            self._socket = s
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._socket is not None:
+                try:
+                    # Wakes up the recv of the other thread
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+def send(querystr, host, port, timeout=None, cancellation=None):
+    """
+    Send the query to the mandoline server at host:port through a socket and
+    return the result. Raises socket.timeout if Mandoline doesn't answer within
+    timeout seconds, MANDOLINE_READ_TIMEOUT by default, and Cancelled if the
+    query is cancelled with the optional cancellation.
+    """
+    with phase('mandoline'):
+        s = socket.create_connection((host, port), settings.MANDOLINE_CONNECT_TIMEOUT)
+        try:
+            if cancellation is not None:
+                cancellation._attach(s)
+            s.settimeout(timeout or settings.MANDOLINE_READ_TIMEOUT)
+
+            s.send(querystr + '\r\n')
+            data = bytearray()
+            while 1:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data.extend(chunk)
+        except socket.error:
+            if cancellation is not None and cancellation.cancelled:
+                raise Cancelled()
+            raise
+        finally:
+            s.close()
+
+    if cancellation is not None and cancellation.cancelled:
+        # The reply was cut short by the shutdown
+        raise Cancelled()
+    return data.decode(encoding='utf-8')
@@ -0,0 +1,63 @@
+"""
+Compressed variants of the cached Mandoline replies.
+
+A cached reply requested again is compressed once in the encoding accepted by
+the client, and the variant is cached next to it, so the hot replies are not
+compressed again by gzip_page on every request. Brotli needs the brotli module.
+"""
+from django.conf import settings
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Replies smaller than this are not worth compressing, as for gzip_page
+MIN_SIZE = 200
+# Compression level of the variants, they are compressed once so it is high
+BROTLI_QUALITY = 9
+
+def available():
+    """ Returns the encodings of the variants, by order of preference """
+    return [encoding for encoding in settings.MANDOLINE_PRECOMPRESSED
+            if encoding == 'gzip' or (encoding == 'br' and brotli is not None)]
+
+def negotiate(accept_encoding):
+    """ Returns the preferred encoding of the variants accepted by the client, or None """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].strip().lower()] = quality
+
+    encodings = available()
+    best = None
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[0]):
+            best = (quality, encoding)
+    return best[1] if best is not None else None
+
+def variant_key(key, encoding):
+    """ Returns the cache key of a variant of the reply cached under key """
+    return '%s\n%s' % (encoding, key)
+
+def compress(reply, encoding):
+    """ Returns the reply compressed in encoding, or None if it is not worth it """
+    if isinstance(reply, unicode):
+        reply = reply.encode('utf-8')
+    if len(reply) < MIN_SIZE:
+        return None
+    if encoding == 'br':
+        compressed = brotli.compress(reply, quality=BROTLI_QUALITY)
+    else:
+        compressed = compress_string(reply)
+    return compressed if len(compressed) < len(reply) else None
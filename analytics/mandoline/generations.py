@@ -0,0 +1,147 @@
+"""
+Generations of the data of the Mandoline cubes, to invalidate cached replies lazily.
+
+The ETL notifies the cubes it reloaded, or the hierarchies of a cube whose
+members changed, through the mandoline_invalidate view or the invalidate_cubes
+command. The notifications change the generations of the cubes and
+hierarchies, and the keys of the cached replies include the generations of
+the cube and of the hierarchies the query depends on: outdated replies are
+never used again and are evicted as the cache fills, while the replies on the
+other cubes stay cached.
+
+The generations are counters in the database (CubeGeneration), shared by the
+worker processes of all the hosts and kept across restarts. Each process
+memoizes the generations it reads for MANDOLINE_GENERATIONS_TTL seconds, so
+the notifications of the ETL are seen by the other processes after that
+delay at most. The generations read by a thread are also memoized while it
+is in a memoized() block, so a query sees the same ones throughout.
+"""
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db.models import F
+
+from analytics.models import CubeGeneration
+
+_local = threading.local()
+
+# Generations read by this process, by pk: (generation, expiry time)
+_cache = {}
+_cache_lock = threading.Lock()
+
+# Generation of all the cubes, for full invalidations
+_ALL = 'all'
+
+def _pk(cube, hierarchy=None):
+    """ Cube and hierarchy ids may contain characters not allowed in cache keys """
+    name = cube if hierarchy is None else u'%s\n%s' % (cube, hierarchy)
+    return hashlib.md5(name.encode('utf-8')).hexdigest()
+
+def dependencies(request_json):
+    """ Returns the cube a query depends on and the list of its hierarchies whose members it depends on """
+    data = request_json.get('data')
+    if not isinstance(data, dict):
+        return None, []
+    if request_json.get('queryType') == 'data':
+        hierarchies = set()
+        for part in ('onRows', 'where'):
+            if isinstance(data.get(part), dict):
+                hierarchies.update(data[part])
+        return data.get('from'), sorted(hierarchies)
+
+    root = data.get('root')
+    if not isinstance(root, list) or len(root) < 2:
+        return None, []
+    return root[1], root[3:4]
+
+class memoized(object):
+    """ Context manager memoizing the generations read by this thread until the outermost block exits """
+
+    def __enter__(self):
+        self.outermost = getattr(_local, 'generations', None) is None
+        if self.outermost:
+            _local.generations = {}
+
+    def __exit__(self, *exc_info):
+        if self.outermost:
+            _local.generations = None
+
+def _generations(pks):
+    """ Returns the generation of each of pks, with one query for the ones not memoized """
+    memo = getattr(_local, 'generations', None)
+    if memo is None:
+        memo = {}
+    missing = [pk for pk in pks if pk not in memo]
+    if not missing:
+        return [memo[pk] for pk in pks]
+
+    now = time.time()
+    with _cache_lock:
+        for pk in missing:
+            cached = _cache.get(pk)
+            if cached is not None and cached[1] > now:
+                memo[pk] = cached[0]
+    missing = [pk for pk in missing if pk not in memo]
+    if missing:
+        found = dict(CubeGeneration.objects.filter(key__in=missing).values_list('key', 'generation'))
+        expiry = time.time() + settings.MANDOLINE_GENERATIONS_TTL
+        with _cache_lock:
+            for pk in missing:
+                memo[pk] = found.get(pk, 0)
+                _cache[pk] = (memo[pk], expiry)
+    return [memo[pk] for pk in pks]
+
+def generation(cube, hierarchies=()):
+    """ Returns a string identifying the current generation of the data of a cube and of some of its hierarchies """
+    pks = [_ALL]
+    if isinstance(cube, basestring):
+        pks.append(_pk(cube))
+        pks.extend(_pk(cube, hierarchy) for hierarchy in hierarchies if isinstance(hierarchy, basestring))
+    return hashlib.md5(' '.join(str(g) for g in _generations(pks))).hexdigest()
+
+def query_generation(request_json):
+    """ Returns the generation of the data a query depends on """
+    return generation(*dependencies(request_json))
+
+def invalidate(cube=None, hierarchies=None):
+    """
+    Invalidate the cached data of the hierarchies of a cube, or of the whole
+    cube if no hierarchy is given, or of all the cubes if no cube is given.
+    """
+    if cube is None:
+        pks = [_ALL]
+    elif not hierarchies:
+        pks = [_pk(cube)]
+    else:
+        pks = [_pk(cube, hierarchy) for hierarchy in hierarchies]
+
+    for pk in pks:
+        CubeGeneration.objects.get_or_create(key=pk)
+    CubeGeneration.objects.filter(key__in=pks).update(generation=F('generation') + 1)
+    with _cache_lock:
+        for pk in pks:
+            _cache.pop(pk, None)
+    memo = getattr(_local, 'generations', None)
+    if memo is not None:
+        for pk in pks:
+            memo.pop(pk, None)
+
+def notify(notification):
+    """
+    Apply a notification of the ETL, {"cube": cube} when the cube was reloaded
+    or {"cube": cube, "members": {hierarchy: [member, ...]}} when members of
+    some hierarchies changed. A missing cube invalidates all the cubes. The
+    members are invalidated with their whole hierarchy. Raises ValueError if
+    the notification is not valid.
+    """
+    if not isinstance(notification, dict):
+        raise ValueError('A notification must be an object')
+    cube = notification.get('cube')
+    members = notification.get('members') or {}
+    if (cube is not None and not isinstance(cube, basestring)) or not isinstance(members, dict):
+        raise ValueError('Invalid cube or members')
+    if members and cube is None:
+        raise ValueError('Members need a cube')
+    invalidate(cube, sorted(members))
@@ -0,0 +1,218 @@
+"""
+Paginated and searchable lists of the members of a level.
+
+The proxy answers the "members" queries, which Mandoline doesn't know:
+
+    {
+        "queryType": "members",
+        "data": {
+            "root": [schema, cube, dimension, hierarchy, level],
+            "search": "par",          // optional
+            "mode": "prefix",         // or "substring"
+            "offset": 0,
+            "limit": 100,
+            "withProperties": true
+        }
+    }
+
+The reply data is the list of the members of the page, in the order of the
+level or of their captions when searching, and total is the number of members
+matching the search.
+
+The members of each level are indexed from the metadata of Mandoline, without
+their properties. An index older than MANDOLINE_MEMBER_INDEX_TTL is refreshed
+from a new list of the members, only the differences are applied to it. The
+properties are fetched for the members of the page only. An index is also
+refreshed when the ETL notifies changes of its hierarchy (see generations.py).
+At most MANDOLINE_MEMBER_INDEXES_SIZE indexes are kept, the least recently
+used ones are dropped, and a level is only fetched by one request at a time.
+"""
+import json
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from analytics.mandoline import generations
+
+_BAD_REQUEST = json.dumps({'error': 'BAD_REQUEST', 'data': {}})
+
+class MemberIndex(object):
+    """ Members of a level, in their order and sorted by caption """
+
+    def __init__(self):
+        self.order = []
+        self.captions = {}
+        self._sorted = []
+        self.updated_at = None
+        self.generation = None
+
+    def update(self, members):
+        """ Apply the differences with members, an ordered mapping of member ids to their captions """
+        for member in set(self.captions) - set(members):
+            self._remove(member)
+        for member, caption in members.items():
+            if self.captions.get(member) != caption:
+                if member in self.captions:
+                    self._remove(member)
+                self.captions[member] = caption
+                bisect.insort(self._sorted, (_normalize(caption), member))
+
+        self.order = list(members)
+        self.updated_at = time.time()
+
+    def copy(self):
+        index = MemberIndex()
+        index.order = list(self.order)
+        index.captions = dict(self.captions)
+        index._sorted = list(self._sorted)
+        index.updated_at = self.updated_at
+        index.generation = self.generation
+        return index
+
+    def _remove(self, member):
+        entry = (_normalize(self.captions.pop(member)), member)
+        del self._sorted[bisect.bisect_left(self._sorted, entry)]
+
+    def search(self, text=None, mode='prefix', offset=0, limit=100):
+        """ Returns the number of members matching text and the ids of the requested page """
+        if not text:
+            return len(self.order), self.order[offset:offset + limit]
+
+        text = _normalize(text)
+        if mode == 'substring':
+            matches = [member for caption, member in self._sorted if text in caption]
+            return len(matches), matches[offset:offset + limit]
+
+        start = bisect.bisect_left(self._sorted, (text,))
+        end = bisect.bisect_left(self._sorted, (text + u'\uffff',))
+        return end - start, [member for caption, member in self._sorted[start + offset:min(end, start + offset + limit)]]
+
+def _normalize(caption):
+    return (caption or u'').lower()
+
+class _Fetch(object):
+    """ Fetch of the members of a level, waited for by the other requests on the level """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MemberIndexes(object):
+    """ Member indexes by role and level, the least recently used ones are dropped """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._indexes = OrderedDict()
+        self._fetches = {}
+        self._lock = threading.Lock()
+
+    def get(self, role, root, fetch):
+        """
+        Returns the index of the level at root, building or refreshing it with
+        fetch if needed, or the reply of Mandoline if it failed. A request
+        needing an index being built by another one waits for it.
+        """
+        key = (role, tuple(root))
+        generation = generations.generation(root[1], root[3:4])
+        with self._lock:
+            index = self._indexes.pop(key, None)
+            if index is not None:
+                self._indexes[key] = index
+            stale = (index is None or time.time() - index.updated_at > self.ttl
+                     or index.generation != generation)
+            pending = self._fetches.get(key)
+            if index is not None and (not stale or pending is not None):
+                return index
+            if pending is None:
+                current = self._fetches[key] = _Fetch()
+
+        if pending is not None:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            current.result = self._fetch(key, role, root, fetch, index, generation)
+            return current.result
+        except Exception, e:
+            current.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[key]
+            current.done.set()
+
+    def _fetch(self, key, role, root, fetch, index, generation):
+        """ Build or refresh the index of a level, returns it or the reply of Mandoline """
+        query = {'queryType': 'metadata', 'data': {'root': root, 'withProperties': False}}
+        if role is not None:
+            query['role'] = role
+        reply = fetch(query)
+        reply_json = json.loads(reply, object_pairs_hook=OrderedDict)
+        if reply_json.get('error') != 'OK' or not isinstance(reply_json.get('data'), dict):
+            return index or reply
+
+        members = OrderedDict((member, (value or {}).get('caption'))
+                              for member, value in reply_json['data'].items())
+        # The index is updated on a copy as other threads may be searching it
+        new_index = index.copy() if index is not None else MemberIndex()
+        new_index.update(members)
+        new_index.generation = generation
+        with self._lock:
+            self._indexes.pop(key, None)
+            self._indexes[key] = new_index
+            while len(self._indexes) > self.size:
+                self._indexes.popitem(last=False)
+        return new_index
+
+    def invalidate(self, cube=None):
+        """ Mark the indexes of a cube, or all of them, as outdated """
+        with self._lock:
+            for (role, root), index in self._indexes.items():
+                if cube is None or root[1] == cube:
+                    index.updated_at = 0
+
+_indexes = MemberIndexes(settings.MANDOLINE_MEMBER_INDEX_TTL, settings.MANDOLINE_MEMBER_INDEXES_SIZE)
+
+def query(request_json, fetch):
+    """ Returns the reply to a members query, fetch is used to query Mandoline """
+    data = request_json.get('data')
+    if not isinstance(data, dict):
+        return _BAD_REQUEST
+    root = data.get('root')
+    try:
+        offset = int(data.get('offset', 0))
+        limit = min(int(data.get('limit', 100)), settings.MANDOLINE_MEMBERS_PAGE_MAX)
+    except (TypeError, ValueError):
+        return _BAD_REQUEST
+    if (not isinstance(root, list) or len(root) != 5 or offset < 0 or limit < 0
+            or data.get('mode', 'prefix') not in ('prefix', 'substring')):
+        return _BAD_REQUEST
+
+    role = request_json.get('role')
+    index = _indexes.get(role, root, fetch)
+    if not isinstance(index, MemberIndex):
+        return index
+
+    total, page = index.search(data.get('search'), data.get('mode', 'prefix'), offset, limit)
+    members = [{'id': member, 'caption': index.captions.get(member)} for member in page]
+
+    if data.get('withProperties') and page:
+        query = {'queryType': 'metadata',
+                 'data': {'root': root + [page], 'withProperties': True, 'granularity': 0}}
+        if role is not None:
+            query['role'] = role
+        reply = fetch(query)
+        reply_json = json.loads(reply)
+        if reply_json.get('error') != 'OK':
+            return reply
+        for member in members:
+            member.update(reply_json['data'].get(member['id']) or {})
+
+    return json.dumps({'error': 'OK', 'data': members, 'total': total})
@@ -0,0 +1,272 @@
+import copy
+import json
+import threading
+import itertools
+from collections import OrderedDict
+
+# Number of cached results the planner considers for each cube and filters
+_MAX_ENTRIES_PER_FAMILY = 50
+
+# Number of families of queries remembered, the families of the previous
+# generations of the data are dropped as new ones are created
+_MAX_FAMILIES = 1000
+
+# Number of parent members whose children are remembered
+_MAX_PARENTS = 10000
+
+def canonical(obj):
+    """ Returns a string identifying a JSON object regardless of its keys order """
+    return json.dumps(obj, sort_keys=True)
+
+class _Entry(object):
+    """ A data query whose result is cached, with the row key of each diced hierarchy """
+
+    def __init__(self, rows, measures, keys):
+        self.rows = rows
+        self.measures = measures
+        self.keys = keys
+
+class QueryPlanner(object):
+    """
+    Answers data queries from the results of previous queries when possible.
+
+    A query can be answered from a cached result of the same cube with the
+    same filters (role and where) and the same hierarchies on rows when it
+    asks for a subset of the measures and, for each diced hierarchy:
+
+    - a subset of the cached members (sub-slice)
+    - parents of cached members (roll-up), their children being learnt from
+      the metadata queries going through the proxy. This sums the cells so it
+      is only done when all the measures are additive.
+
+    Members that can't be answered locally are queried from Mandoline when
+    they all belong to the same hierarchy, the rest is computed locally.
+
+    Results and children are only used while the generation of the data they
+    depend on is unchanged.
+    """
+
+    def __init__(self, cache, additive_measures, generation=None):
+        """
+        cache is the cache of the Mandoline replies, additive_measures maps
+        cube ids to the list of their measures that can be summed. generation
+        returns the generation of the data of a cube and of a list of its
+        hierarchies (see generations.generation).
+        """
+        self.cache = cache
+        self.additive_measures = additive_measures
+        self.generation = generation or (lambda cube, hierarchies=(): '')
+        self._families = OrderedDict()
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, key, query, reply):
+        """ Remember a successful reply cached under key """
+        if query.get('queryType') == 'data':
+            self._record_data(key, query, reply)
+        elif query.get('queryType') == 'metadata':
+            self._record_metadata(query, reply)
+
+    def _record_data(self, key, query, reply):
+        data = query['data']
+        rows = data.get('onRows') or {}
+        measures = data.get('onColumns') or []
+        keys = _row_keys(rows, measures, reply['data'])
+        if keys is None:
+            return
+
+        family_key = self._family(query)
+        with self._lock:
+            family = self._families.pop(family_key, None) or OrderedDict()
+            self._families[family_key] = family
+            family.pop(key, None)
+            family[key] = _Entry(rows, measures, keys)
+            while len(family) > _MAX_ENTRIES_PER_FAMILY:
+                family.popitem(last=False)
+            while len(self._families) > _MAX_FAMILIES:
+                self._families.popitem(last=False)
+
+    def _record_metadata(self, query, reply):
+        root = query['data'].get('root') or []
+        if len(root) != 6 or not isinstance(root[5], basestring) or not isinstance(reply['data'], dict):
+            return
+
+        generation = self.generation(root[1], [root[3]])
+        with self._lock:
+            self._children[(query.get('role'), root[1], root[3], root[5])] = (list(reply['data']), generation)
+            while len(self._children) > _MAX_PARENTS:
+                self._children.popitem(last=False)
+
+    def answer(self, query, fetch):
+        """
+        Returns the reply to a data query computed from cached results, or None
+        if it can't be answered this way. fetch is used to query Mandoline for
+        the missing members.
+        """
+        if query.get('queryType') != 'data' or not _is_valid(query.get('data')):
+            return None
+
+        family_key = self._family(query)
+        with self._lock:
+            entries = list(reversed(self._families.get(family_key, {}).items()))
+
+        data = query['data']
+        rows = data.get('onRows') or {}
+        measures = data.get('onColumns') or []
+
+        generations = {}
+        for key, entry in entries:
+            plan = self._match(query, entry, rows, measures, generations)
+            if plan is None:
+                continue
+
+            reply = self.cache.get(key)
+            if reply is None:
+                with self._lock:
+                    self._families.get(family_key, {}).pop(key, None)
+                continue
+
+            targets, missing = plan
+            cells = _compute(json.loads(reply)['data'], entry, targets, measures)
+
+            if missing:
+                missing_query = copy.deepcopy(query)
+                for hierarchy, members in missing.items():
+                    missing_query['data']['onRows'][hierarchy]['members'] = members
+                missing_reply = json.loads(fetch(missing_query))
+                if missing_reply.get('error') != 'OK':
+                    return None
+                cells.extend(missing_reply['data'])
+
+            return json.dumps({'error': 'OK', 'data': cells})
+
+        return None
+
+    def _match(self, query, entry, rows, measures, generations):
+        """
+        Returns (targets, missing) if the query can be answered from entry.
+        targets maps each diced hierarchy to a dict giving the requested members
+        each cached member contributes to, missing maps a hierarchy to the
+        requested members that must be fetched from Mandoline. generations
+        memoizes the generations of the hierarchies.
+        """
+        if not set(measures) <= set(entry.measures) or set(rows) != set(entry.rows):
+            return None
+
+        cube = query['data'].get('from')
+        rollup = False
+        targets = {}
+        missing = {}
+
+        for hierarchy, spec in rows.items():
+            cached = entry.rows[hierarchy]
+            if not (spec.get('dice') and cached.get('dice')) or spec.get('range') or cached.get('range'):
+                if canonical(spec) != canonical(cached):
+                    return None
+                continue
+
+            available = set(cached.get('members') or [])
+            contributions = {}
+            absent = []
+            for member in spec.get('members') or []:
+                if member in available:
+                    contributions.setdefault(member, []).append(member)
+                    continue
+                with self._lock:
+                    children, children_generation = self._children.get(
+                        (query.get('role'), cube, hierarchy, member), (None, None))
+                if children and hierarchy not in generations:
+                    generations[hierarchy] = self.generation(cube, [hierarchy])
+                if children and children_generation == generations[hierarchy] and set(children) <= available:
+                    for child in children:
+                        contributions.setdefault(child, []).append(member)
+                    rollup = True
+                else:
+                    absent.append(member)
+
+            if absent:
+                if len(absent) == len(spec.get('members') or []):
+                    return None
+                missing[hierarchy] = absent
+            targets[hierarchy] = contributions
+
+        if len(missing) > 1:
+            return None
+        if rollup and not set(measures) <= set(self.additive_measures.get(cube, ())):
+            return None
+
+        return targets, missing
+
+    def _family(self, query):
+        """ Returns the key of the queries that can be answered from one another, in the current generation """
+        data = query['data']
+        hierarchies = set(data.get('onRows') or {})
+        if isinstance(data.get('where'), dict):
+            hierarchies.update(data['where'])
+        return _family(query) + (self.generation(data.get('from'), sorted(hierarchies)),)
+
+def _is_valid(data):
+    """ Checks the structure of a data query, Mandoline reports the other errors """
+    if not isinstance(data, dict):
+        return False
+    rows = data.get('onRows') or {}
+    return (isinstance(rows, dict) and all(isinstance(spec, dict) for spec in rows.values())
+            and isinstance(data.get('onColumns') or [], list))
+
+def _family(query):
+    """ Returns the key of the queries that can be answered from one another """
+    data = query['data']
+    return (query.get('role'), data.get('from'), canonical(data.get('where') or {}))
+
+def _row_keys(rows, measures, cells):
+    """
+    Returns the key used in the cells for each diced hierarchy. This is the
+    only key whose values are all members of the hierarchy. Returns None if
+    a hierarchy can't be matched to a single key.
+    """
+    keys = set(key for cell in cells for key in cell) - set(measures)
+    result = {}
+    for hierarchy, spec in rows.items():
+        if not spec.get('dice') or not cells:
+            continue
+        members = set(spec.get('members') or [])
+        candidates = [key for key in keys if all(cell.get(key) in members for cell in cells)]
+        if len(candidates) != 1:
+            return None
+        result[hierarchy] = candidates[0]
+
+    if len(set(result.values())) != len(result):
+        return None
+    return result
+
+def _compute(cells, entry, targets, measures):
+    """
+    Computes the cells of a query from the cells of a cached entry: each cached
+    cell is added to the requested members it contributes to.
+    """
+    hierarchies = [h for h in targets if h in entry.keys]
+    dimension_keys = [entry.keys[h] for h in hierarchies]
+    skipped = set(entry.measures) | set(dimension_keys)
+
+    groups = OrderedDict()
+    for cell in cells:
+        contributions = [targets[h].get(cell.get(entry.keys[h])) for h in hierarchies]
+        if not all(contributions):
+            continue
+
+        base = dict((k, v) for k, v in cell.items() if k not in skipped)
+        for members in itertools.product(*contributions):
+            group_key = (canonical(base),) + members
+            if group_key not in groups:
+                group = dict(base)
+                group.update(zip(dimension_keys, members))
+                groups[group_key] = group
+            group = groups[group_key]
+
+            for measure in measures:
+                if measure not in cell:
+                    continue
+                value, current = cell[measure], group.get(measure)
+                group[measure] = value if current is None else (current if value is None else current + value)
+
+    return groups.values()
@@ -0,0 +1,196 @@
+"""
+Cache of the Mandoline replies shared by the worker processes of a host.
+
+The cache is a file mapped in memory by every process (in /dev/shm it never
+touches the disk), so a reply is stored once per host and a lookup is a hash,
+a few struct reads and a copy of the value, without any serialization.
+
+The file holds a header, an index and a data area:
+
+- the index is set associative: a key can only be stored in the WAYS slots of
+  the set given by its hash, and when they are all used the least recently
+  used one is replaced
+- the data area is a ring written sequentially: the entries written over are
+  evicted, so the space goes to the most recently written entries
+
+The processes read the cache concurrently under a shared flock on the file,
+the writes take it exclusively. The replacement is an approximate LRU: a
+read only stamps its slot with the clock of the last write, so reads never
+write the header, and the slots read since the last write count as used as
+recently as it. A read copies its value out of the mapping, as the entry can
+be written over once the lock is released. The threads of a process share
+the flock, so they are serialized by a lock.
+
+manage.py benchmark_shared_cache measures the reads and writes under
+concurrency.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+
+_MAGIC = 'ANLYTC01'
+# magic, number of sets, ways, data size, clock, head, next old entry, end of old entries
+_HEADER = struct.Struct('<8sIIQQQQQ')
+_HEADER_SIZE = 64
+# key hash, entry offset, key length, value length, last use
+_SLOT = struct.Struct('<QQIIQ')
+# last use, the last field of a slot
+_LAST_USE = struct.Struct('<Q')
+_LAST_USE_OFFSET = _SLOT.size - _LAST_USE.size
+# slot index, entry length
+_ENTRY = struct.Struct('<II')
+
+WAYS = 8
+
+class SharedCache(object):
+    """ Shared memory cache with the interface of cache.LRUCache """
+
+    def __init__(self, path, size, slots):
+        """ size is the size of the data area in bytes, slots the number of entries of the index """
+        self.path = path
+        self.nsets = max(1, slots // WAYS)
+        self.data_size = size
+        self._index_size = self.nsets * WAYS * _SLOT.size
+        self._data_offset = _HEADER_SIZE + self._index_size
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """ Map the file, once per process since the flocks must not be shared with the parent """
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            total = self._data_offset + self.data_size
+            header = os.read(fd, _HEADER.size)
+            valid = (len(header) == _HEADER.size and os.fstat(fd).st_size == total and
+                     _HEADER.unpack(header)[:4] == (_MAGIC, self.nsets, WAYS, self.data_size))
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, total)
+            self._mm = mmap.mmap(fd, total)
+            if not valid:
+                self._write_header(0, 0, 0, 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def _locked(self, operation, function, *args):
+        """ Calls function with the flock operation (LOCK_SH or LOCK_EX) held """
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, operation)
+            try:
+                return function(*args)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_header(self):
+        return _HEADER.unpack_from(self._mm, 0)[4:]
+
+    def _write_header(self, clock, head, next_old, old_end):
+        _HEADER.pack_into(self._mm, 0, _MAGIC, self.nsets, WAYS, self.data_size,
+                          clock, head, next_old, old_end)
+
+    def _slot_offset(self, slot):
+        return _HEADER_SIZE + slot * _SLOT.size
+
+    def _find(self, key, key_hash):
+        """ Returns the slot of key and the index of its set's first slot """
+        first = (key_hash % self.nsets) * WAYS
+        for slot in range(first, first + WAYS):
+            h, offset, key_length, value_length, last_use = _SLOT.unpack_from(self._mm, self._slot_offset(slot))
+            if h == key_hash and key_length == len(key):
+                start = self._data_offset + offset + _ENTRY.size
+                if self._mm[start:start + key_length] == key:
+                    return slot, first
+        return None, first
+
+    def get(self, key):
+        """ Returns the value cached for key or None, as a byte string """
+        key = _encode(key)
+        return self._locked(fcntl.LOCK_SH, self._get, key, _hash(key))
+
+    def _get(self, key, key_hash):
+        slot, first = self._find(key, key_hash)
+        if slot is None:
+            return None
+        clock = self._read_header()[0]
+        h, offset, key_length, value_length, last_use = _SLOT.unpack_from(self._mm, self._slot_offset(slot))
+        if last_use != clock:
+            # Concurrent readers can only write the same clock here
+            _LAST_USE.pack_into(self._mm, self._slot_offset(slot) + _LAST_USE_OFFSET, clock)
+        start = self._data_offset + offset + _ENTRY.size + key_length
+        return self._mm[start:start + value_length]
+
+    def set(self, key, value):
+        """ Caches value for key, unicode values are encoded in UTF-8 and values larger than the data area are not cached """
+        key = _encode(key)
+        value = _encode(value)
+        if _ENTRY.size + len(key) + len(value) <= self.data_size:
+            self._locked(fcntl.LOCK_EX, self._set, key, _hash(key), value)
+
+    def _set(self, key, key_hash, value):
+        slot, first = self._find(key, key_hash)
+        if slot is None:
+            slots = [(_SLOT.unpack_from(self._mm, self._slot_offset(s))[4], s) for s in range(first, first + WAYS)]
+            slot = min(slots)[1]
+
+        clock, head, next_old, old_end = self._read_header()
+        length = _ENTRY.size + len(key) + len(value)
+        if head + length > self.data_size:
+            # Wrap around: the end of the ring is evicted and the entries of
+            # the cycle that just ended become the old entries
+            while next_old < old_end:
+                next_old += self._evict(next_old)
+            next_old, old_end, head = 0, head, 0
+        while next_old < old_end and next_old < head + length:
+            next_old += self._evict(next_old)
+
+        start = self._data_offset + head
+        _ENTRY.pack_into(self._mm, start, slot, length)
+        self._mm[start + _ENTRY.size:start + _ENTRY.size + len(key)] = key
+        self._mm[start + _ENTRY.size + len(key):start + length] = value
+
+        clock += 1
+        _SLOT.pack_into(self._mm, self._slot_offset(slot), key_hash, head, len(key), len(value), clock)
+        self._write_header(clock, head + length, next_old, old_end)
+
+    def _evict(self, offset):
+        """ Evicts the entry at offset of the data area if its slot still points to it, returns its length """
+        slot, length = _ENTRY.unpack_from(self._mm, self._data_offset + offset)
+        h, slot_offset = _SLOT.unpack_from(self._mm, self._slot_offset(slot))[:2]
+        if h and slot_offset == offset:
+            self._clear_slot(slot)
+        return length
+
+    def _clear_slot(self, slot):
+        _SLOT.pack_into(self._mm, self._slot_offset(slot), 0, 0, 0, 0, 0)
+
+    def delete(self, key):
+        key = _encode(key)
+        self._locked(fcntl.LOCK_EX, self._delete, key, _hash(key))
+
+    def _delete(self, key, key_hash):
+        slot, first = self._find(key, key_hash)
+        if slot is not None:
+            self._clear_slot(slot)
+
+    def clear(self):
+        self._locked(fcntl.LOCK_EX, self._clear)
+
+    def _clear(self):
+        self._mm[_HEADER_SIZE:self._data_offset] = '\0' * self._index_size
+        self._write_header(0, 0, 0, 0)
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _hash(key):
+    """ Returns a non null 64 bits hash of key, 0 marks the empty slots """
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] | 1
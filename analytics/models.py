@@ -1,13 +1,24 @@
 from django.db import models
-from django.db.models import signals
+from django.db.models import signals, Q
+from django.db.models.loading import get_model
 from django.core.urlresolvers import reverse
 from django.contrib.contenttypes.models import ContentType
 
-from geonode.api.resourcebase_api import CommonModelApi, CommonMetaApi
 from geonode.base.models import ResourceBase, resourcebase_post_save
 from geonode.people.models import Profile
 
 from agon_ratings.models import OverallRating
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from analytics.versions import bump_version
+
+import json
+import operator
+import threading
+
+# Set while bulk_delete_analyses() runs, the ratings, permissions and
+# versions are then handled in bulk
+_bulk_delete = threading.local()
 
 class Analysis(ResourceBase):
     """ Class representing an analysis, it inherits GeoNode's base resource class """
@@ -21,23 +32,158 @@ class Analysis(ResourceBase):
     def class_name(self):
         return self.__class__.__name__
 
+class AnalysisContent(models.Model):
+    """ Index of the contents of the saved state of an analysis, to search analyses by their contents """
+    KINDS = (
+        ('cube', 'Cube'),
+        ('measure', 'Measure'),
+        ('dimension', 'Dimension'),
+        ('hierarchy', 'Hierarchy'),
+        ('chart', 'Chart type'),
+    )
+
+    analysis = models.ForeignKey(Analysis, related_name='contents')
+    kind = models.CharField(max_length=16, choices=KINDS)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('analysis', 'kind', 'value')
+        index_together = [('kind', 'value')]
+
+def analysis_contents(data):
+    """ Returns the set of the (kind, value) pairs of the contents of the state of an analysis, as saved """
+    try:
+        state = json.loads(data)
+    except (TypeError, ValueError):
+        return set()
+    if not isinstance(state, dict):
+        return set()
+
+    contents = set()
+    def add(kind, value):
+        if isinstance(value, basestring) and value:
+            contents.add((kind, value[:255]))
+
+    add('cube', state.get('cube'))
+    add('measure', state.get('measure'))
+    for dimension in state.get('dimensions') or []:
+        if isinstance(dimension, dict):
+            add('dimension', dimension.get('id'))
+            add('hierarchy', dimension.get('hierarchy'))
+    for column in state.get('charts') or []:
+        for chart in column if isinstance(column, list) else []:
+            if isinstance(chart, dict):
+                add('chart', chart.get('type'))
+                for measure in chart.get('extraMeasures') or []:
+                    add('measure', measure)
+    return contents
+
+def index_analysis_contents(analysis_id, data):
+    """ Update the index of the contents of an analysis with the differences with its data """
+    indexed = set(AnalysisContent.objects.filter(analysis=analysis_id).values_list('kind', 'value'))
+    contents = analysis_contents(data)
+
+    removed = indexed - contents
+    if removed:
+        AnalysisContent.objects.filter(
+            reduce(operator.or_, (Q(kind=kind, value=value) for kind, value in removed)),
+            analysis=analysis_id).delete()
+    AnalysisContent.objects.bulk_create([
+        AnalysisContent(analysis_id=analysis_id, kind=kind, value=value)
+        for kind, value in contents - indexed
+    ])
+
+class AnalysisVersion(models.Model):
+    """
+    A saved state of an analysis. Checkpoints hold the whole state, the other
+    versions hold their differences with their checkpoint (see analytics.history).
+    """
+    analysis = models.ForeignKey(Analysis, related_name='versions')
+    number = models.PositiveIntegerField()
+    # Number of the checkpoint the differences apply to, the version's own number for a checkpoint
+    checkpoint = models.PositiveIntegerField()
+    data = models.TextField()
+    user = models.ForeignKey(Profile, null=True, blank=True, on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('analysis', 'number')
+        ordering = ('-number',)
+
+    @property
+    def is_checkpoint(self):
+        return self.number == self.checkpoint
+
+class FragmentVersion(models.Model):
+    """ Version of a kind of data of an analysis shown in cached fragments (see analytics.versions) """
+    # kind and id of the analysis, e.g. permissions:42
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+
+class CubeGeneration(models.Model):
+    """
+    Generation of the data of a Mandoline cube or of one of its hierarchies,
+    incremented by the notifications of the ETL (see analytics.mandoline.generations).
+    """
+    # md5 of the cube id, or of the cube and hierarchy ids
+    key = models.CharField(max_length=32, primary_key=True)
+    generation = models.PositiveIntegerField(default=0)
+
 class GeoMondrianRole(models.Model):
     """ Class used to connect users to GeoMondrian roles """
     rolename = models.CharField(max_length=100, unique=True)
     users = models.ManyToManyField(Profile, related_name="geomondrianrole")
 
-class AnalysisResource(CommonModelApi):
-    """ Class to be used in the search API of GeoNode """
-    class Meta(CommonMetaApi):
-        queryset = Analysis.objects.distinct().order_by('-date')
-        resource_name = 'analysis'
-
 def pre_delete_analysis(instance, sender, **kwrargs):
     """ Function called before the deletion of an analysis """
+    if getattr(_bulk_delete, 'active', False):
+        return
     ct = ContentType.objects.get_for_model(instance)
     OverallRating.objects.filter(
         content_type=ct,
         object_id=instance.id).delete()
 
+def analysis_changed(instance, sender, **kwargs):
+    """ Function called after an analysis is saved, its cached fragments are outdated """
+    bump_version('analysis', instance.id)
+
+def index_contents(instance, sender, raw=False, **kwargs):
+    """ Function called after an analysis is saved to update the index of its contents """
+    if not raw:
+        index_analysis_contents(instance.id, instance.data)
+
+def document_changed(instance, sender, **kwargs):
+    """ Function called after a document is saved or deleted """
+    if getattr(_bulk_delete, 'active', False):
+        return
+    if instance.object_id is not None and instance.content_type_id == ContentType.objects.get_for_model(Analysis).id:
+        bump_version('analysis', instance.object_id)
+
+def permission_changed(instance, sender, **kwargs):
+    """ Function called after an object permission is given or removed """
+    if getattr(_bulk_delete, 'active', False):
+        return
+    if instance.content_type_id == ContentType.objects.get_for_model(ResourceBase).id:
+        bump_version('permissions', instance.object_pk)
+
+def connect_document_signals(sender, **kwargs):
+    """ Connect the handlers of the documents once GeoNode's Document model is loaded """
+    if sender._meta.app_label == 'documents' and sender._meta.object_name == 'Document':
+        signals.post_save.connect(document_changed, sender=sender)
+        signals.post_delete.connect(document_changed, sender=sender)
+
 signals.pre_delete.connect(pre_delete_analysis, sender=Analysis)
 signals.post_save.connect(resourcebase_post_save, sender=Analysis)
+signals.post_save.connect(analysis_changed, sender=Analysis)
+signals.post_save.connect(index_contents, sender=Analysis)
+for sender in (UserObjectPermission, GroupObjectPermission):
+    signals.post_save.connect(permission_changed, sender=sender)
+    signals.post_delete.connect(permission_changed, sender=sender)
+
+# The documents models are not imported here so that loading the analyses
+# doesn't load them, the handlers are connected when they are
+_document = get_model('documents', 'Document', seed_cache=False, only_installed=False)
+if _document is not None:
+    connect_document_signals(_document)
+else:
+    signals.class_prepared.connect(connect_document_signals)
@@ -0,0 +1,162 @@
+"""
+Profiling of single requests, for staff users.
+
+A view decorated with profiled is profiled when a staff user requests it with
+the profile=1 query parameter or the X-Analytics-Profile header. The Python
+stack of the request is then sampled every PROFILING_INTERVAL seconds and the
+time spent in each phase of the request is measured:
+
+- permissions: resolution of the analysis and of the user's permissions
+- db: the database queries (of all the phases)
+- mandoline: waiting for the replies of the Mandoline servers
+- serialization: parsing the queries and rendering the responses
+
+The phases are sent in the Server-Timing header of the response, and the
+samples are stored for PROFILING_TIMEOUT seconds in a file of PROFILING_DIR
+as a collapsed-stack profile (the input of flamegraph.pl or speedscope),
+whose URL is sent in the X-Analytics-Profile header. PROFILING_DIR has no
+default: it must be shared by the hosts serving the app for the URL to work
+whatever host gets the request. Requests that are not profiled only pay for the
+check of the flag.
+"""
+import os
+import sys
+import time
+import threading
+from uuid import uuid4
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+
+_local = threading.local()
+
+class phase(object):
+    """ Context manager measuring a phase of the profiled request of this thread, if any """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = getattr(_local, 'profile', None)
+        if self.profile is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.add(self.name, time.time() - self.start)
+
+class Profile(object):
+    """ Samples the stack of a thread and sums the durations of its phases """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.phases = {}
+        self.stacks = {}
+        self._running = False
+        self._sampler = None
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def start(self):
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        self._running = False
+        self._sampler.join()
+
+    def _sample(self):
+        while self._running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('%s.%s' % (frame.f_globals.get('__name__'), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                stack = ';'.join(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """ Returns the samples in the collapsed-stack format, a stack and its number of samples per line """
+        return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+def _requested(request):
+    return ((request.GET.get('profile') or request.META.get('HTTP_X_ANALYTICS_PROFILE'))
+            and request.user.is_staff)
+
+def profiled(view):
+    """ Decorator profiling the view when requested (see the module documentation) """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not _requested(request):
+            return view(request, *args, **kwargs)
+        if not settings.PROFILING_DIR:
+            raise ImproperlyConfigured('PROFILING_DIR must be set to profile requests')
+
+        # Imported here as the requests that are not profiled don't need them
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        profile = Profile(threading.current_thread().ident, settings.PROFILING_INTERVAL)
+        _local.profile = profile
+        profile.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request, *args, **kwargs)
+        finally:
+            profile.stop()
+            _local.profile = None
+
+        profile.add('db', sum(float(query['time']) for query in queries))
+        profile_id = uuid4().hex
+        _store(profile_id, profile.collapsed())
+        response['Server-Timing'] = ', '.join('%s;dur=%.1f' % (name, duration * 1000)
+                                              for name, duration in sorted(profile.phases.items()))
+        response['X-Analytics-Profile'] = reverse('analytics_profile', args=(profile_id,))
+        return response
+    return wrapper
+
+def _path(profile_id):
+    return os.path.join(settings.PROFILING_DIR, '%s.txt' % profile_id)
+
+def _store(profile_id, collapsed):
+    """ Write a profile, and delete the expired ones """
+    if not os.path.isdir(settings.PROFILING_DIR):
+        try:
+            os.makedirs(settings.PROFILING_DIR)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(settings.PROFILING_DIR):
+                raise
+
+    expired = time.time() - settings.PROFILING_TIMEOUT
+    for name in os.listdir(settings.PROFILING_DIR):
+        path = os.path.join(settings.PROFILING_DIR, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            # Deleted by another process
+            pass
+
+    with open(_path(profile_id), 'w') as f:
+        f.write(collapsed)
+
+def get_profile(profile_id):
+    """ Returns a stored profile in the collapsed-stack format, or None if it expired """
+    if not settings.PROFILING_DIR:
+        return None
+    try:
+        if os.path.getmtime(_path(profile_id)) < time.time() - settings.PROFILING_TIMEOUT:
+            return None
+        with open(_path(profile_id)) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
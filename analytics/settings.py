@@ -20,6 +20,7 @@
 
 # Django settings for the GeoNode project.
 import os
+import tempfile
 from geonode.settings import *
 #
 # General Django development settings
@@ -118,5 +119,80 @@ ANONYMOUS_GEOMONDRIAN_ROLE= 'anonymous'
 
 MANDOLINE_HOST = 'localhost'
 MANDOLINE_PORT = 25335
+# Timeouts of the connection to Mandoline and of its replies, in seconds
+MANDOLINE_CONNECT_TIMEOUT = 5
+MANDOLINE_READ_TIMEOUT = 120
+
+# Admission control of the queries sent to Mandoline, the limits apply to
+# all the worker processes of the host. None disables a limit.
+MANDOLINE_ADMISSION = {
+    'USER_LIMIT': 4,      # queries in flight per user (per IP for anonymous users)
+    'ROLE_LIMIT': 16,     # queries in flight per GeoMondrian role
+    'ROLE_LIMITS': {},    # ROLE_LIMIT overrides by role name
+    # File whose locks count the queries in flight of the processes of the
+    # host, None applies the limits to each process
+    'SHARED_PATH': os.path.join(tempfile.gettempdir(), 'analytics-admission.lock'),
+    'QUEUE_SIZE': 32,     # queries waiting for a slot in each process, the others are rejected
+    'QUEUE_TIMEOUT': 10,  # seconds a query waits for a slot
+    'FAILURES': 5,        # consecutive failures opening the circuit breaker of a server
+    'RESET_TIMEOUT': 30,  # seconds before trying the server again
+}
+# Anonymous users are limited per client address: behind a reverse proxy
+# REMOTE_ADDR is the proxy's, set MANDOLINE_CLIENT_IP_HEADER to the header
+# holding the client address (e.g. 'HTTP_X_FORWARDED_FOR'), otherwise all the
+# anonymous users share the USER_LIMIT.
+MANDOLINE_CLIENT_IP_HEADER = None
+
+# Mandoline servers the queries are spread over, e.g.
+# [{'HOST': 'olap1', 'PORT': 25335, 'WEIGHT': 2}, {'HOST': 'olap2', 'PORT': 25335}]
+# None uses MANDOLINE_HOST and MANDOLINE_PORT
+MANDOLINE_BACKENDS = None
+# 'least-outstanding' or 'cube' to always send the queries on a cube to the same server
+MANDOLINE_ROUTING = 'least-outstanding'
+# Send slow queries to a second server as well (after the 95th percentile of the latencies)
+MANDOLINE_HEDGING = False
+# Seconds before the member lists indexed by the proxy are refreshed
+MANDOLINE_MEMBER_INDEX_TTL = 3600
+# Maximal number of member indexes kept per process, the least recently used
+# ones are dropped (there is an index per level and per role)
+MANDOLINE_MEMBER_INDEXES_SIZE = 256
+# Maximal number of members in a page of a members query
+MANDOLINE_MEMBERS_PAGE_MAX = 1000
+# Seconds between two health checks of the servers, 0 disables them
+MANDOLINE_HEALTH_CHECK_INTERVAL = 10
+
+# Number of Mandoline replies cached by the proxy, 0 disables the cache
+MANDOLINE_CACHE_SIZE = 0
+# Answer data queries from cached finer results (needs the cache)
+MANDOLINE_QUERY_PLANNER = False
+# Measures that can be summed to answer roll-ups, by cube id
+# e.g. {'Sales': ['Amount', 'Quantity']}
+MANDOLINE_ADDITIVE_MEASURES = {}
+# Share the cache between the worker processes of the host, in a file mapped
+# in memory, instead of a cache per process of MANDOLINE_CACHE_SIZE entries.
+# e.g. {'PATH': '/dev/shm/analytics-mandoline', 'SIZE': 256 * 1024 * 1024, 'SLOTS': 65536}
+# with SIZE the bytes of replies kept and SLOTS the maximal number of replies
+MANDOLINE_SHARED_CACHE = None
+# Encodings in which the cached replies requested again are kept compressed,
+# by order of preference ('br' needs the brotli module), () disables them
+MANDOLINE_PRECOMPRESSED = ('br', 'gzip')
+# Secret the ETL sends to notify the cubes it changed, None disables the endpoint
+MANDOLINE_INVALIDATION_TOKEN = None
+# Seconds each process keeps the generations of the cubes it read, the other
+# processes see an invalidation after this delay at most
+MANDOLINE_GENERATIONS_TTL = 1
+
+# Versions between two full copies of the state of an analysis in its history
+ANALYSIS_HISTORY_CHECKPOINT_INTERVAL = 20
+# Number of versions kept per analysis, 0 keeps them all
+ANALYSIS_HISTORY_RETENTION = 200
+
+# Seconds between two samples of the stack of a profiled request (see analytics/profiling.py)
+PROFILING_INTERVAL = 0.005
+# Seconds the profiles of the requests are kept
+PROFILING_TIMEOUT = 3600
+# Directory of the profiles, it must be shared by the hosts serving the app and
+# is required to profile requests (e.g. a directory of a network file system)
+PROFILING_DIR = None
 
 JS_TESTING = False
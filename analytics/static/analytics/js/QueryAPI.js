@@ -198,6 +198,22 @@ QueryAPI = function() {
         return send("metadata", data);
     };
 
+    /**
+     * Returns a page of the members of a level, optionally filtered by a
+     * search on their captions. The reply data is the list of the members
+     * of the page and the reply total the number of matching members.
+     * @param {String[]} root Array of 5 elements, the schema, cube, dimension,
+     *  hierarchy and level of the members.
+     * @param {Object} options search (String), mode ("prefix" or "substring"),
+     *  offset (Int), limit (Int) and withProperties (Boolean).
+     *
+     */
+    this.members = function(root, options) {
+
+        var data = $.extend({ "root": root }, options);
+        return send("members", data);
+    };
+
     /**
      * Format the queryType and data to be in the JSON result. Then sends the JSON
      * results to the user.
@@ -1,16 +1,40 @@
 from django.test import TestCase
-from django.test.client import Client
+from django.test.utils import override_settings
+from django.test.client import Client, RequestFactory
 
 from django.core.urlresolvers import reverse
+from django.core.management import call_command
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.admin.models import LogEntry, DELETION
+from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured
 from django.contrib.contenttypes.models import ContentType
 
 from geonode.base.populate_test_data import create_models
 
-from analytics.models import Analysis
-
+from analytics.models import Analysis, CubeGeneration
+from analytics.bulk import bulk_delete_analyses
+from analytics.versions import get_versions
+from analytics.views import _requester
+from analytics.mandoline import compression, generations
+from analytics.mandoline.cache import LRUCache
+from analytics.mandoline.admission import CircuitBreaker, Limiter, SharedLimiter, Rejected
+from analytics.mandoline.backends import Backend, BackendPool
+from analytics.mandoline.members import MemberIndex, MemberIndexes
+from analytics.mandoline.planner import QueryPlanner, canonical
+from analytics.mandoline.shmcache import SharedCache
+
+import copy
+import gzip
 import json
+import os
+import signal
+import socket
+import threading
+from collections import OrderedDict
+import tempfile
+import time
+from StringIO import StringIO
 
 from functools import wraps
 from itertools import repeat
@@ -81,6 +105,18 @@ class AnalyticsTest(TestCase):
         response = self.client.get(reverse('new_analysis'))
         self.assertEqual(response.status_code, 200)
 
+    def test_client_config(self):
+        """ Test that the client configuration of the viewer is cached forever at its current version. """
+        response = self.client.get(reverse('new_analysis'))
+        version = response.context['client_config_version']
+        response = self.client.get(reverse('client_config', args=(version,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('ANALYTICS_CONFIG', response.content)
+
+        response = self.client.get(reverse('client_config', args=('outdated',)))
+        self.assertNotIn('immutable', response['Cache-Control'])
+
     @loggedIn
     def test_analysis_view(self):
         """ Test that the analysis view page doesn't return an error """
@@ -137,6 +173,43 @@ class AnalyticsTest(TestCase):
         analysis = Analysis.objects.get(id=a)
         self.assertEquals(analysis.data, '"test data"')
 
+    @loggedIn
+    @override_settings(ANALYSIS_HISTORY_CHECKPOINT_INTERVAL=3, ANALYSIS_HISTORY_RETENTION=4)
+    def test_analysis_versions(self):
+        """ Test that the updates of an analysis are kept as versions that can be restored. """
+        a = self.fixtures['3']
+        states = [{"cube": "Sales", "measure": "m%d" % i, "dimensions": [{"id": "Geo"}] * 10} for i in range(6)]
+        for state in states:
+            self.client.put(reverse('analysis_data', args=(a,)), data=json.dumps({"data": state}),
+                            content_type='text/json')
+
+        versions = json.loads(self.client.get(reverse('analysis_versions', args=(a,))).content)
+        # 2 is beyond the retention but 1 is the checkpoint of 3
+        self.assertEqual([version['number'] for version in versions], [6, 5, 4, 3, 1])
+        self.assertFalse(versions[0]['checkpoint'])
+
+        response = self.client.get(reverse('analysis_version', args=(a, 4)))
+        self.assertEqual(json.loads(response.content), states[3])
+        response = self.client.post(reverse('analysis_version_restore', args=(a, 4)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(Analysis.objects.get(id=a).data), states[3])
+        self.assertEqual(json.loads(self.client.get(reverse('analysis_versions', args=(a,))).content)[0]['number'], 7)
+        self.assertEqual(self.client.get(reverse('analysis_version', args=(a, 99))).status_code, 404)
+
+    @loggedIn
+    def test_analysis_first_version(self):
+        """ Test that the state saved before the analysis had a history is kept as its first version. """
+        a = Analysis.objects.get(id=self.fixtures['3'])
+        a.data = json.dumps({"cube": "Stock"})
+        a.save()
+        self.client.put(reverse('analysis_data', args=(a.id,)), data=json.dumps({"data": {"cube": "Sales"}}),
+                        content_type='text/json')
+
+        versions = json.loads(self.client.get(reverse('analysis_versions', args=(a.id,))).content)
+        self.assertEqual([version['number'] for version in versions], [2, 1])
+        response = self.client.get(reverse('analysis_version', args=(a.id, 1)))
+        self.assertEqual(json.loads(response.content), {"cube": "Stock"})
+
     @loggedIn
     def test_bad_request_analysis_update(self):
         """ Test the return code of the update view if the request is malformed. """
@@ -220,3 +293,454 @@ class AnalyticsTest(TestCase):
         print response.status_code
         self.assertIn('config', response.context)
         self.assertEqual(response.context['config'], u"{'testData': '1'}")
+
+    def test_import_export_analyses(self):
+        """ Test that exported analyses can be imported back with their permissions. """
+        export = tempfile.NamedTemporaryFile(suffix='.ndjson')
+        call_command('export_analyses', export.name)
+        lines = open(export.name).read().splitlines()
+        self.assertEqual(len(lines), Analysis.objects.count())
+
+        count = Analysis.objects.count()
+        call_command('import_analyses', export.name, batch_size=2)
+        self.assertEqual(Analysis.objects.count(), 2 * count)
+
+        imported = Analysis.objects.order_by('-id')[0]
+        original = Analysis.objects.get(id=self.fixtures[imported.title])
+        self.assertEqual(imported.data, original.data)
+        self.assertTrue(get_user_model().objects.get(username='admin').has_perm(
+            'base.change_resourcebase', imported.get_self_resource()))
+
+    def test_import_without_signals(self):
+        """ Test that analyses imported without signals get the fields GeoNode sets after a save. """
+        export = tempfile.NamedTemporaryFile(suffix='.ndjson')
+        call_command('export_analyses', export.name)
+        call_command('import_analyses', export.name, send_signals=False)
+
+        imported = Analysis.objects.order_by('-id')[0]
+        self.assertEqual(imported.detail_url, imported.get_absolute_url())
+        self.assertEqual(imported.poc, imported.owner)
+        self.assertEqual(imported.metadata_author, imported.owner)
+        self.assertTrue(imported.owner.has_perm('base.change_resourcebase', imported.get_self_resource()))
+
+    def test_bulk_analysis_remove(self):
+        """ Test that bulk deletion removes the analyses and their ratings. """
+        ids = [self.fixtures['1'], self.fixtures['2']]
+        ctype = ContentType.objects.get(model='analysis')
+        for a in ids:
+            OverallRating.objects.create(category=3, object_id=a, content_type=ctype, rating=3)
+
+        self.assertEqual(bulk_delete_analyses(Analysis.objects.filter(id__in=ids)), 2)
+        self.assertEqual(Analysis.objects.filter(id__in=ids).count(), 0)
+        self.assertEqual(OverallRating.objects.filter(object_id__in=ids, content_type=ctype).count(), 0)
+        self.assertTrue(Analysis.objects.filter(id=self.fixtures['3']).exists())
+
+    @loggedIn
+    def test_admin_delete(self):
+        """ Test that the admin deletes analyses after a confirmation and logs their deletions. """
+        get_user_model().objects.filter(username='admin').update(is_staff=True)
+        url = reverse('admin:analytics_analysis_changelist')
+        data = {'action': 'delete_selected', '_selected_action': [self.fixtures['1'], self.fixtures['2']]}
+        response = self.client.post(url, data)
+        self.assertTemplateUsed(response, 'admin/delete_selected_confirmation.html')
+        self.assertEqual(Analysis.objects.filter(id__in=data['_selected_action']).count(), 2)
+
+        data['post'] = 'yes'
+        self.client.post(url, data)
+        self.assertEqual(Analysis.objects.filter(id__in=data['_selected_action']).count(), 0)
+        self.assertEqual(LogEntry.objects.filter(action_flag=DELETION).count(), 2)
+
+    def test_fragment_versions(self):
+        """ Test that saving an analysis or its permissions changes the versions of its cached fragments. """
+        a = Analysis.objects.get(id=self.fixtures['1'])
+        versions = get_versions(('analysis', a.id), ('permissions', a.id))
+        a.save()
+        self.assertNotEqual(get_versions(('analysis', a.id))[0], versions[0])
+        a.set_default_permissions()
+        self.assertNotEqual(get_versions(('permissions', a.id))[0], versions[1])
+
+    @loggedIn
+    @override_settings(PROFILING_DIR=os.path.join(tempfile.gettempdir(), 'analytics-test-profiles'))
+    def test_profile(self):
+        """ Test that staff users can profile a request and download its profile. """
+        url = reverse('analysis_view', args=(self.fixtures['1'],))
+        self.assertNotIn('X-Analytics-Profile', self.client.get(url, {'profile': 1}))
+
+        get_user_model().objects.filter(username='admin').update(is_staff=True)
+        response = self.client.get(url, {'profile': 1})
+        self.assertIn('permissions;dur=', response['Server-Timing'])
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertEqual(self.client.get(response['X-Analytics-Profile']).status_code, 200)
+
+        with self.settings(PROFILING_DIR=None):
+            self.assertRaises(ImproperlyConfigured, self.client.get, url, {'profile': 1})
+
+    def test_analysis_contents(self):
+        """ Test that the contents of saved analyses are indexed and can be searched through the API. """
+        a = Analysis.objects.get(id=self.fixtures['1'])
+        a.data = json.dumps({
+            "schema": "Olap", "cube": "Sales", "measure": "Amount",
+            "dimensions": [{"id": "Geo", "hierarchy": "Geo.Zones"}],
+            "charts": [[], [{"type": "bar", "dimensions": ["Geo"], "extraMeasures": ["Quantity"]}]]
+        })
+        a.save()
+        self.assertEqual(set(a.contents.values_list('kind', 'value')), set([
+            ("cube", "Sales"), ("measure", "Amount"), ("measure", "Quantity"),
+            ("dimension", "Geo"), ("hierarchy", "Geo.Zones"), ("chart", "bar")]))
+
+        url = reverse('api_dispatch_list', kwargs={'api_name': 'api', 'resource_name': 'analysis'})
+        response = self.client.get(url, {'cube': 'Sales', 'measure': 'Quantity'})
+        self.assertEqual([o['id'] for o in json.loads(response.content)['objects']], [a.id])
+        response = self.client.get(url, {'cube': 'Sales', 'chart': 'pie'})
+        self.assertEqual(json.loads(response.content)['objects'], [])
+
+        a.contents.all().delete()
+        call_command('index_analyses')
+        self.assertEqual(a.contents.filter(kind='cube').get().value, "Sales")
+
+class QueryPlannerTest(TestCase):
+    def setUp(self):
+        self.cache = LRUCache(10)
+        self.planner = QueryPlanner(self.cache, {'Sales': ['amount']})
+        self.query = {
+            "queryType": "data",
+            "data": {
+                "from": "Sales",
+                "onColumns": ["amount", "average"],
+                "onRows": {"Geo.Zones": {"members": ["FR1", "FR2", "BE1"], "dice": True, "range": False}},
+                "where": {}
+            }
+        }
+        reply = {"error": "OK", "data": [
+            {"Geo": "FR1", "amount": 1, "average": 5},
+            {"Geo": "FR2", "amount": 2, "average": 6},
+            {"Geo": "BE1", "amount": 4, "average": 7},
+        ]}
+        self._record(self.query, reply)
+        self._record({
+            "queryType": "metadata",
+            "data": {"root": ["Olap", "Sales", "Geo", "Geo.Zones", "Countries", "FR"], "withProperties": False, "granularity": 1}
+        }, {"error": "OK", "data": {"FR1": {"caption": "Paris"}, "FR2": {"caption": "Lyon"}}})
+
+    def _record(self, query, reply):
+        key = canonical(query)
+        self.cache.set(key, json.dumps(reply))
+        self.planner.record(key, query, reply)
+
+    def _query(self, members, measures):
+        query = copy.deepcopy(self.query)
+        query['data']['onRows']['Geo.Zones']['members'] = members
+        query['data']['onColumns'] = measures
+        return query
+
+    def _fail(self, query):
+        self.fail("Mandoline should not be queried")
+
+    def test_sub_slice(self):
+        """ Test that a subset of cached members and measures is answered locally. """
+        reply = json.loads(self.planner.answer(self._query(["FR2"], ["average"]), self._fail))
+        self.assertEqual(reply['data'], [{"Geo": "FR2", "average": 6}])
+
+    def test_roll_up(self):
+        """ Test that parents of cached members are computed by summing additive measures. """
+        reply = json.loads(self.planner.answer(self._query(["FR", "BE1"], ["amount"]), self._fail))
+        self.assertEqual(reply['data'], [{"Geo": "FR", "amount": 3}, {"Geo": "BE1", "amount": 4}])
+        self.assertIsNone(self.planner.answer(self._query(["FR"], ["average"]), self._fail))
+
+    def test_missing_members(self):
+        """ Test that only the members missing from the cache are queried. """
+        def fetch(query):
+            self.assertEqual(query['data']['onRows']['Geo.Zones']['members'], ["LU1"])
+            return json.dumps({"error": "OK", "data": [{"Geo": "LU1", "amount": 8}]})
+
+        reply = json.loads(self.planner.answer(self._query(["BE1", "LU1"], ["amount"]), fetch))
+        self.assertEqual(reply['data'], [{"Geo": "BE1", "amount": 4}, {"Geo": "LU1", "amount": 8}])
+
+class AdmissionTest(TestCase):
+    @override_settings(MANDOLINE_CLIENT_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_anonymous_requester(self):
+        """ Test that anonymous users are limited by the client address given by the reverse proxy. """
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.254', HTTP_X_FORWARDED_FOR='192.0.2.1, 10.0.0.1')
+        request.user = AnonymousUser()
+        self.assertEqual(_requester(request), '192.0.2.1')
+
+    def test_limiter(self):
+        """ Test that queries over the limit are rejected once the queue is full. """
+        limiter = Limiter(queue_size=0, timeout=0)
+        limits = [('user:1', 1), ('role:anonymous', None)]
+        limiter.acquire(limits)
+        self.assertRaises(Rejected, limiter.acquire, limits)
+        limiter.acquire([('user:2', 1), ('role:anonymous', None)])
+        limiter.release(limits)
+        limiter.acquire(limits)
+
+    def test_shared_limiter(self):
+        """ Test that the queries in flight of the other processes count, until they die. """
+        path = tempfile.mktemp()
+        limits = [('user:1', 1), ('role:anonymous', None)]
+        ready, done = os.pipe(), os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            SharedLimiter(path, 0, 0).acquire(limits)
+            os.write(ready[1], 'x')
+            os.read(done[0], 1)
+            os._exit(0)
+        try:
+            os.read(ready[0], 1)
+            limiter = SharedLimiter(path, 0, 0)
+            self.assertRaises(Rejected, limiter.acquire, limits)
+            limiter.acquire([('user:2', 1), ('role:anonymous', None)])
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        limiter.acquire(limits)
+        os.remove(path)
+
+    def test_circuit_breaker(self):
+        """ Test that the circuit opens after consecutive failures and lets a trial query through. """
+        breaker = CircuitBreaker(failures=2, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        breaker.reset_timeout = 60
+        with self.assertRaises(Rejected) as cm:
+            breaker.before()
+        self.assertEqual(cm.exception.retry_after, 60)
+
+        breaker.reset_timeout = 0
+        breaker.before()
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertRaises(Rejected, breaker.before)
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+
+class BackendPoolTest(TestCase):
+    def setUp(self):
+        self.backends = [Backend('olap%d' % i, 25335) for i in range(3)]
+        self.query = {"queryType": "data", "data": {"from": "Sales", "onColumns": [], "onRows": {}, "where": {}}}
+
+    def test_least_outstanding(self):
+        """ Test that queries go to the server with the least outstanding queries. """
+        pool = BackendPool(self.backends)
+        self.backends[0].outstanding = 2
+        self.backends[1].outstanding = 1
+        self.assertEqual(pool.candidates(self.query), [self.backends[2], self.backends[1], self.backends[0]])
+
+    def test_weights(self):
+        """ Test that idle servers are chosen in proportion to their weights. """
+        heavy, light = Backend('olap0', 25335, weight=3), Backend('olap1', 25335)
+        pool = BackendPool([heavy, light])
+        firsts = [pool.candidates(self.query)[0] for i in range(2000)]
+        self.assertTrue(0.7 < firsts.count(heavy) / 2000.0 < 0.8)
+
+    def test_retry(self):
+        """ Test that a query failing on a server is sent to the next one. """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        def serve():
+            connection, address = listener.accept()
+            connection.recv(65536)
+            connection.sendall('{"ok": true}')
+            connection.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        broken, working = Backend('127.0.0.1', closed_port), Backend('127.0.0.1', listener.getsockname()[1])
+        working.outstanding = 1
+        try:
+            self.assertEqual(BackendPool([broken, working]).send(self.query), '{"ok": true}')
+        finally:
+            listener.close()
+        self.assertEqual(broken.breaker.failures, 1)
+
+    def test_cube_routing(self):
+        """ Test that queries on a cube always go to the same healthy server. """
+        pool = BackendPool(self.backends, routing='cube')
+        first = pool.candidates(self.query)[0]
+        metadata = {"queryType": "metadata", "data": {"root": ["Olap", "Sales"]}}
+        self.assertEqual(pool.candidates(metadata)[0], first)
+
+        first.healthy = False
+        self.assertNotIn(first, pool.candidates(self.query))
+        self.assertEqual(len(pool.candidates(self.query)), 2)
+
+    def test_open_circuits(self):
+        """ Test that a query is rejected when the circuits of all the servers are open. """
+        pool = BackendPool(self.backends[:1])
+        self.backends[0].breaker.opened_at = time.time()
+        self.assertRaises(Rejected, pool.send, self.query)
+
+class MemberIndexTest(TestCase):
+    def setUp(self):
+        self.index = MemberIndex()
+        self.index.update(OrderedDict([("75", "Paris"), ("13", "Marseille"), ("69", "Lyon"), ("77", "Parisis")]))
+
+    def test_pages(self):
+        """ Test that members are paginated in their order without a search. """
+        self.assertEqual(self.index.search(offset=1, limit=2), (4, ["13", "69"]))
+
+    def test_search(self):
+        """ Test the prefix and substring searches on the captions. """
+        self.assertEqual(self.index.search("pari", limit=1), (2, ["75"]))
+        self.assertEqual(self.index.search("pari", offset=1), (2, ["77"]))
+        self.assertEqual(self.index.search("SEI", mode="substring"), (1, ["13"]))
+
+    def test_update(self):
+        """ Test that refreshing the index applies the differences. """
+        self.index.update(OrderedDict([("75", "Paris"), ("69", "Lyon 1er"), ("33", "Bordeaux")]))
+        self.assertEqual(self.index.search(), (3, ["75", "69", "33"]))
+        self.assertEqual(self.index.search("lyon"), (1, ["69"]))
+        self.assertEqual(self.index.search("mars"), (0, []))
+
+class MemberIndexesTest(TestCase):
+    def setUp(self):
+        self.reply = json.dumps({'error': 'OK', 'data': {'75': {'caption': 'Paris'}}})
+
+    def test_size(self):
+        """ Test that the least recently used indexes are dropped. """
+        indexes = MemberIndexes(3600, 2)
+        fetch = lambda query: self.reply
+        roots = [['Olap', 'Sales', 'Store', 'Store', level] for level in ('Country', 'Region', 'City')]
+        first = indexes.get(None, roots[0], fetch)
+        indexes.get(None, roots[1], fetch)
+        self.assertIs(indexes.get(None, roots[0], fetch), first)
+        indexes.get(None, roots[2], fetch)
+        self.assertEqual(len(indexes._indexes), 2)
+        self.assertIs(indexes.get(None, roots[0], fetch), first)
+
+    def test_single_fetch(self):
+        """ Test that concurrent requests for a missing index wait for a single fetch. """
+        indexes = MemberIndexes(3600, 2)
+        root = ['Olap', 'Sales', 'Store', 'Store', 'City']
+        queries = []
+        def fetch(query):
+            queries.append(query)
+            time.sleep(0.2)
+            return self.reply
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(indexes.get(None, root, fetch)))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(set(id(index) for index in results)), 1)
+
+class SharedCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        self.cache = SharedCache(self.path, 1024, 16)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_shared(self):
+        """ Test that entries are seen by other instances of the cache on the file. """
+        self.cache.set(u"key", u"r\xe9ponse")
+        self.assertEqual(SharedCache(self.path, 1024, 16).get(u"key"), u"r\xe9ponse".encode("utf-8"))
+        self.cache.delete(u"key")
+        self.assertIsNone(SharedCache(self.path, 1024, 16).get(u"key"))
+
+    def test_eviction(self):
+        """ Test that written over entries are evicted and that values larger than the cache are ignored. """
+        for i in range(10):
+            self.cache.set("key %d" % i, "x" * 200)
+        self.assertIsNone(self.cache.get("key 0"))
+        self.assertEqual(self.cache.get("key 9"), "x" * 200)
+        self.cache.set("big", "x" * 2000)
+        self.assertIsNone(self.cache.get("big"))
+
+    def test_replacement(self):
+        """ Test that the least recently used entry of a full set is replaced. """
+        cache = SharedCache(self.path, 4096, 8)
+        for i in range(8):
+            cache.set("key %d" % i, "value")
+        cache.get("key 0")
+        cache.set("key 8", "value")
+        self.assertEqual(cache.get("key 0"), "value")
+        self.assertIsNone(cache.get("key 1"))
+
+@override_settings(MANDOLINE_PRECOMPRESSED=('gzip',))
+class CompressionTest(TestCase):
+    def test_negotiate(self):
+        """ Test that the variant is chosen from the Accept-Encoding header. """
+        self.assertEqual(compression.negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(compression.negotiate("deflate, *;q=0.5"), "gzip")
+        self.assertIsNone(compression.negotiate("gzip;q=0, deflate"))
+        self.assertIsNone(compression.negotiate(""))
+
+    def test_compress(self):
+        """ Test that only the replies worth it are compressed. """
+        reply = json.dumps({"error": "OK", "data": [{"Zone": "75", "Amount": 1}] * 50})
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compression.compress(reply, "gzip"))).read(), reply)
+        self.assertIsNone(compression.compress('{"error": "OK", "data": []}', "gzip"))
+
+class GenerationsTest(TestCase):
+    def setUp(self):
+        self.sales = {"queryType": "data", "data": {"from": "Sales", "onColumns": ["amount"],
+                                                    "onRows": {"Geo.Zones": {"members": ["FR1"], "dice": True}}}}
+        self.stock = {"queryType": "metadata", "data": {"root": ["Olap", "Stock", "Time", "Time.Years"]}}
+        # The generations read by the previous tests were rolled back
+        generations._cache.clear()
+
+    def test_invalidate(self):
+        """ Test that notifications only change the generations of the queries depending on the changed data. """
+        sales, stock = generations.query_generation(self.sales), generations.query_generation(self.stock)
+        generations.notify({"cube": "Sales", "members": {"Product.Brands": ["B1"]}})
+        self.assertEqual(generations.query_generation(self.sales), sales)
+        generations.notify({"cube": "Sales", "members": {"Geo.Zones": ["FR1"]}})
+        self.assertNotEqual(generations.query_generation(self.sales), sales)
+        self.assertEqual(generations.query_generation(self.stock), stock)
+        generations.notify({})
+        self.assertNotEqual(generations.query_generation(self.stock), stock)
+        self.assertRaises(ValueError, generations.notify, {"members": {"Geo.Zones": []}})
+
+    def test_memoized(self):
+        """ Test that the generations are read once by a query. """
+        with self.assertNumQueries(1):
+            with generations.memoized():
+                generation = generations.query_generation(self.sales)
+                self.assertEqual(generations.query_generation(self.sales), generation)
+
+    @override_settings(MANDOLINE_GENERATIONS_TTL=0.1)
+    def test_process_memo(self):
+        """ Test that a process reads the generations once per MANDOLINE_GENERATIONS_TTL. """
+        generation = generations.query_generation(self.sales)
+        with self.assertNumQueries(0):
+            self.assertEqual(generations.query_generation(self.sales), generation)
+
+        # Invalidation by another process
+        CubeGeneration.objects.create(key=generations._pk('Sales'), generation=1)
+        self.assertEqual(generations.query_generation(self.sales), generation)
+        time.sleep(0.1)
+        self.assertNotEqual(generations.query_generation(self.sales), generation)
+
+    def test_planner(self):
+        """ Test that the planner doesn't use the results of previous generations. """
+        planner = QueryPlanner(LRUCache(10), {}, generations.generation)
+        key = canonical(self.sales)
+        reply = {"error": "OK", "data": [{"Geo": "FR1", "amount": 1}]}
+        planner.cache.set(key, json.dumps(reply))
+        planner.record(key, self.sales, reply)
+        self.assertIsNotNone(planner.answer(self.sales, None))
+        generations.invalidate("Sales")
+        self.assertIsNone(planner.answer(self.sales, None))
+
+    @override_settings(MANDOLINE_INVALIDATION_TOKEN='secret')
+    def test_invalidate_view(self):
+        """ Test that only the ETL can notify changes. """
+        url = reverse('mandoline_invalidate')
+        sales = generations.query_generation(self.sales)
+        body = json.dumps([{"cube": "Stock"}])
+        self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 403)
+        response = self.client.post(url, body, content_type='application/json', HTTP_X_INVALIDATION_TOKEN='secret')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(generations.query_generation(self.sales), sales)
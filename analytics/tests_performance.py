@@ -0,0 +1,136 @@
+"""
+Query count and latency regression tests of the analytics views, they only
+run when ANALYTICS_PERF is set.
+
+The views are measured on a database seeded with ANALYTICS_PERF_SEED analyses
+(1000 by default) and compared with the baseline stored in the JSON file
+ANALYTICS_PERF_BASELINE (analytics/perf_baseline.json by default): a test
+fails when a view makes more queries than in the baseline, or is slower by
+more than ANALYTICS_PERF_TOLERANCE (0.25 by default). Views missing from the
+baseline are only measured. Run the tests with ANALYTICS_PERF_RECORD=1 to
+write the measures as the new baseline.
+
+Independently of the baseline, the number of queries of a view must not
+depend on the number of items it shows.
+"""
+import os
+import json
+import time
+import unittest
+
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.core.urlresolvers import reverse
+from django.contrib.auth import get_user_model
+
+from geonode.base.populate_test_data import create_models
+
+from analytics.models import Analysis
+from analytics.bulk import bulk_create_analyses
+
+ENABLED = bool(os.environ.get('ANALYTICS_PERF'))
+SEED = int(os.environ.get('ANALYTICS_PERF_SEED', 1000))
+BASELINE = os.environ.get('ANALYTICS_PERF_BASELINE',
+                          os.path.join(os.path.dirname(__file__), 'perf_baseline.json'))
+TOLERANCE = float(os.environ.get('ANALYTICS_PERF_TOLERANCE', 0.25))
+RECORD = bool(os.environ.get('ANALYTICS_PERF_RECORD'))
+
+# Number of times a view is requested, its median latency is kept
+REPEAT = 5
+
+_measures = {}
+
+def _load_baseline():
+    if not os.path.exists(BASELINE):
+        return {}
+    with open(BASELINE) as f:
+        return json.load(f)
+
+@unittest.skipUnless(ENABLED, 'set ANALYTICS_PERF to run the performance tests')
+class PerformanceTest(TestCase):
+    baseline = _load_baseline()
+
+    @classmethod
+    def setUpClass(cls):
+        """ Seed the database once for all the tests, in a transaction rolled back by tearDownClass """
+        super(PerformanceTest, cls).setUpClass()
+        cls._atomic = transaction.atomic()
+        cls._atomic.__enter__()
+
+        create_models()
+        cls.user, _ = get_user_model().objects.get_or_create(username='admin', is_superuser=True)
+        bulk_create_analyses(
+            (Analysis(owner=cls.user, title='%d' % i, abstract='abstract %d' % i,
+                      data=json.dumps({'testData': '%d' % i}))
+             for i in range(SEED)),
+            send_signals=False)
+        cls.analysis = Analysis.objects.order_by('id')[0]
+        cls.analysis.poc = cls.user
+        cls.analysis.metadata_author = cls.user
+        cls.analysis.save()
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.needs_rollback = True
+        cls._atomic.__exit__(None, None, None)
+        super(PerformanceTest, cls).tearDownClass()
+        if RECORD and _measures:
+            baseline = _load_baseline()
+            baseline.update(_measures)
+            with open(BASELINE, 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+
+    def setUp(self):
+        self.client = Client()
+        self.client.login(username='admin', password='admin')
+
+    def _measure(self, url):
+        """ Returns the number of queries and the median latency of a GET on url """
+        latencies = []
+        for i in range(REPEAT):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                response = self.client.get(url)
+                latencies.append(time.time() - start)
+            self.assertEqual(response.status_code, 200)
+        return len(queries), sorted(latencies)[REPEAT // 2]
+
+    def _check(self, name, url):
+        """ Measures a view and compares it with the baseline """
+        queries, latency = self._measure(url)
+        _measures[name] = {'queries': queries, 'latency': latency}
+        if RECORD or name not in self.baseline:
+            return queries
+
+        expected = self.baseline[name]
+        self.assertLessEqual(queries, expected['queries'],
+                             '%s makes %d queries instead of %d' % (name, queries, expected['queries']))
+        self.assertLessEqual(latency, expected['latency'] * (1 + TOLERANCE),
+                             '%s takes %.3fs instead of %.3fs' % (name, latency, expected['latency']))
+        return queries
+
+    def test_analysis_detail(self):
+        """ Test the queries and latency of the detail page. """
+        self._check('analysis_detail', reverse('analysis_detail', args=(self.analysis.id,)))
+
+    def test_analysis_view(self):
+        """ Test the queries and latency of the viewer page. """
+        self._check('analysis_view', reverse('analysis_view', args=(self.analysis.id,)))
+
+    def test_analysis_metadata(self):
+        """ Test that the metadata page doesn't make a query per keyword. """
+        url = reverse('analysis_metadata', args=(self.analysis.id,))
+        self.analysis.keywords.add('keyword')
+        few = self._measure(url)[0]
+        self.analysis.keywords.add(*['keyword %d' % i for i in range(20)])
+        queries = self._check('analysis_metadata', url)
+        self.assertEqual(queries, few)
+
+    def test_analysis_list_api(self):
+        """ Test that the search API doesn't make a query per analysis. """
+        url = reverse('api_dispatch_list', kwargs={'api_name': 'api', 'resource_name': 'analysis'})
+        few = self._measure(url + '?limit=5')[0]
+        queries = self._check('analysis_list_api', url + '?limit=50')
+        self.assertEqual(queries, few)
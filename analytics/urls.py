@@ -4,19 +4,28 @@ from django.conf.urls import patterns, url
 from geonode.urls import *
 from geonode.api.urls import api
 
-from analytics.models import AnalysisResource
+from analytics.api import AnalysisResource
 
 api.register(AnalysisResource())
 
 urlpatterns = patterns('',
     url(r'^analytics/$', TemplateView.as_view(template_name='analytics/analysis_list.html'), name='analyses_browse'),
     url(r'^analytics/new/$', 'analytics.views.new_analysis', name='new_analysis'),
+    url(r'^analytics/config/(?P<version>\w+)\.js$', 'analytics.views.client_config', name='client_config'),
     url(r'^analytics/new/data/$', 'analytics.views.new_analysis_json', name='new_analysis_json'),
     url(r'^analytics/(?P<analysisid>\d+)/view/$', 'analytics.views.analysis_view', name='analysis_view'),
     url(r'^analytics/(?P<analysisid>\d+)/$', 'analytics.views.analysis_detail', name='analysis_detail'),
     url(r'^analytics/(?P<analysisid>\d+)/data/$', 'analytics.views.analysis_data', name='analysis_data'),
+    url(r'^analytics/(?P<analysisid>\d+)/versions/$', 'analytics.views.analysis_versions', name='analysis_versions'),
+    url(r'^analytics/(?P<analysisid>\d+)/versions/(?P<number>\d+)/$', 'analytics.views.analysis_version',
+        name='analysis_version'),
+    url(r'^analytics/(?P<analysisid>\d+)/versions/(?P<number>\d+)/restore/$',
+        'analytics.views.analysis_version_restore', name='analysis_version_restore'),
     url(r'^analytics/(?P<analysisid>\d+)/remove/$', 'analytics.views.analysis_remove', name='analysis_remove'),
     url(r'^analytics/(?P<analysisid>\d+)/metadata/$', 'analytics.views.analysis_metadata', name='analysis_metadata'),
     url(r'^analytics/api/$', 'analytics.views.mandoline_api', name='mandoline_api'),
+    url(r'^analytics/api/stats/$', 'analytics.views.mandoline_stats', name='mandoline_stats'),
+    url(r'^analytics/api/invalidate/$', 'analytics.views.mandoline_invalidate', name='mandoline_invalidate'),
+    url(r'^analytics/profiles/(?P<profile_id>\w+)\.txt$', 'analytics.views.analysis_profile', name='analytics_profile'),
     url(r'', include(api.urls))
 ) + urlpatterns
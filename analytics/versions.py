@@ -0,0 +1,45 @@
+"""
+Versions of the data shown in the cached fragments of the analyses pages.
+
+A version is changed whenever the data it covers changes, and the cache keys
+of the fragments include it, so outdated fragments are never used again and
+simply expire. The versions are counters in the database (FragmentVersion),
+so a change made by a worker process is seen by all the others whatever the
+cache backend.
+"""
+from django.db.models import F
+
+def _objects():
+    # Imported here as analytics.models imports this module
+    from analytics.models import FragmentVersion
+    return FragmentVersion.objects
+
+def _key(kind, pk):
+    return '%s:%s' % (kind, pk)
+
+def get_versions(*items):
+    """ Returns the current versions of the (kind, pk) items, with one query """
+    keys = [_key(kind, pk) for kind, pk in items]
+    versions = dict(_objects().filter(key__in=keys).values_list('key', 'version'))
+    return [versions.get(key, 0) for key in keys]
+
+def get_version(kind, pk):
+    """ Returns the current version of the kind of data ('analysis', 'permissions') of an analysis """
+    return get_versions((kind, pk))[0]
+
+def bump_version(kind, pk):
+    """ Invalidate the fragments showing this kind of data of an analysis """
+    bump_versions(kind, [pk])
+
+def bump_versions(kind, pks):
+    """ Invalidate the fragments showing this kind of data of each of pks """
+    keys = [_key(kind, pk) for pk in pks]
+    if not keys:
+        return
+    objects = _objects()
+    if objects.filter(key__in=keys).update(version=F('version') + 1) < len(keys):
+        existing = set(objects.filter(key__in=keys).values_list('key', flat=True))
+        for key in keys:
+            if key not in existing:
+                # A concurrent get_or_create also changes the version from 0
+                objects.get_or_create(key=key, defaults={'version': 1})
@@ -12,23 +12,27 @@ from django.views.decorators.cache import never_cache
 from django.shortcuts import render, redirect
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import HttpResponse, HttpResponseRedirect
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
 
 from geonode.utils import resolve_object
-from geonode.base.forms import CategoryForm
-from geonode.base.models import TopicCategory
-from geonode.people.forms import ProfileForm
-from geonode.security.views import _perms_info_json
-from geonode.documents.models import get_related_documents
 
-from analytics.models import Analysis
-from analytics.forms import AnalysisForm
+from analytics.models import Analysis, AnalysisVersion
+from analytics.versions import get_versions
+# Only imports the standard library and Django, its decorator is applied at import
+from analytics.profiling import profiled, phase, get_profile
 
 from django.views.decorators.gzip import gzip_page
 
 import json
 import socket
+import hashlib
 
 _PERMISSION_MSG_DELETE = _("You are not permitted to delete this analysis.")
 _PERMISSION_MSG_GENERIC = _('You do not have permissions for this analysis.')
@@ -37,35 +41,78 @@ _PERMISSION_MSG_METADATA = _("You are not allowed to modify this analysis' metad
 _PERMISSION_MSG_VIEW = _("You are not allowed to view this analysis.")
 _NOT_A_VALID_JSON_DOC = _("Not a valid JSON document.")
 
+# Seconds the fragments of the analyses pages are cached
+_FRAGMENTS_TIMEOUT = 24 * 3600
+
 def _resolve_analysis(request, identifier, permission='base.change_resourcebase',
                       msg=_PERMISSION_MSG_GENERIC, **kwargs):
     """
     Resolve the Analysis by the provided typename and check the optional permission.
     """
-    return resolve_object(request, Analysis, {'pk':identifier}, permission=permission,
-                          permission_msg=msg, **kwargs)
+    with phase('permissions'):
+        return resolve_object(request, Analysis, {'pk':identifier}, permission=permission,
+                              permission_msg=msg, **kwargs)
+
+_client_config = None
+
+def _get_client_config():
+    """
+    Returns the configuration of the analytics-js client as a script, and its
+    version. It only depends on the settings so it is computed once.
+    """
+    global _client_config
+    if _client_config is None:
+        script = 'var ANALYTICS_CONFIG = %s;' % json.dumps({
+            'csts': settings.CSTS,
+            'rolesEnabled': settings.ROLES_ENABLED,
+            'fixtures': settings.FIXTURES,
+        }, sort_keys=True)
+        _client_config = (script, hashlib.md5(script).hexdigest()[:12])
+    return _client_config
+
+def _viewer_context():
+    """ Returns the context shared by the templates of the viewer """
+    return {
+        'client_config_version': _get_client_config()[1],
+        'js_testing': settings.JS_TESTING,
+        'fixtures': settings.FIXTURES,
+    }
+
+def client_config(request, version):
+    """
+    Serves the configuration of the analytics-js client. Its url contains its
+    version so it can be cached forever, unless an old version is requested.
+    """
+    script, current_version = _get_client_config()
+    response = HttpResponse(script, mimetype='application/javascript', status=200)
+    if version == current_version:
+        patch_cache_control(response, public=True, max_age=365 * 24 * 3600, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
 
 def new_analysis(request, template='analytics/analysis_view.html'):
     """ Show a new analysis. A copy parameter can be given, this parameter is
     the id of an analysis from which we should copy the state to display on the
     new analysis """
 
+    context = _viewer_context()
     if request.method == 'GET' and 'copy' in request.GET:
         analysis_obj = _resolve_analysis(request, request.GET['copy'], 'base.view_resourcebase')
-        config = analysis_obj.data
-        return render(request, template, {'config': config})
+        context['config'] = analysis_obj.data
 
-    return render(request, template, {'settings': settings})
+    return render(request, template, context)
 
+@profiled
 def analysis_view(request, analysisid, template='analytics/analysis_view.html'):
     """ The view that show the analytics main viewer. """
     try:
         analysis_obj = _resolve_analysis(request, analysisid, 'base.view_resourcebase', _PERMISSION_MSG_VIEW)
 
-        return render(request, template, {
-            'analysis' : analysis_obj,
-            'settings': settings,
-        })
+        context = _viewer_context()
+        context['analysis'] = analysis_obj
+        with phase('serialization'):
+            return render(request, template, context)
     except PermissionDenied:
         if not request.user.is_authenticated():
             # If the user is not authenticated raising a PermissionDenied redirects him to the login page
@@ -75,16 +122,31 @@ def analysis_view(request, analysisid, template='analytics/analysis_view.html'):
 
 def analysis_detail(request, analysisid, template='analytics/analysis_detail.html'):
     """ The view that show details of each analysis. """
+    # Imported by the views using them, so that loading the URLconf doesn't load them
+    from geonode.security.views import _perms_info_json
+    from geonode.documents.models import get_related_documents
+
     try:
         analysis_obj = _resolve_analysis(request, analysisid, 'base.view_resourcebase', _PERMISSION_MSG_VIEW)
 
+        # Update the counter only, a full save would outdate the cached fragments
+        Analysis.objects.filter(id=analysis_obj.id).update(popular_count=F('popular_count') + 1)
         analysis_obj.popular_count += 1
-        analysis_obj.save()
+
+        permissions_version, documents_version = get_versions(
+            ('permissions', analysis_obj.id), ('analysis', analysis_obj.id))
+        permissions_key = 'analytics:permission_json:%s:%s' % (analysis_obj.id, permissions_version)
+        permission_json = cache.get(permissions_key)
+        if permission_json is None:
+            permission_json = _perms_info_json(analysis_obj)
+            cache.set(permissions_key, permission_json, _FRAGMENTS_TIMEOUT)
 
         return render(request, template, {
             'resource' : analysis_obj,
             'documents' : get_related_documents(analysis_obj),
-            'permission_json' : _perms_info_json(analysis_obj),
+            'documents_version' : documents_version,
+            'fragments_timeout' : _FRAGMENTS_TIMEOUT,
+            'permission_json' : permission_json,
         })
     except PermissionDenied:
         if not request.user.is_authenticated():
@@ -94,6 +156,8 @@ def analysis_detail(request, analysisid, template='analytics/analysis_detail.htm
 
 def analysis_data(request, analysisid):
     """ Update the analysis. """
+    from analytics.history import record_version, record_stored_version
+
     if request.method == 'PUT':
         try:
             analysis_obj = _resolve_analysis(request, analysisid, 'base.change_resourcebase',
@@ -101,7 +165,10 @@ def analysis_data(request, analysisid):
             try:
                 data = json.loads(request.body)
                 analysis_obj.data = json.dumps(data['data'])
-                analysis_obj.save()
+                with transaction.atomic():
+                    record_stored_version(analysis_obj)
+                    analysis_obj.save()
+                    record_version(analysis_obj, request.user)
                 return HttpResponse("Analysis updated", mimetype="text/plain", status=200)
             except (ValueError, KeyError):
                 return HttpResponse(
@@ -119,8 +186,56 @@ def analysis_data(request, analysisid):
     else:
         return HttpResponse(status=405)
 
+def analysis_versions(request, analysisid):
+    """ List the saved versions of an analysis, the most recent first. """
+    try:
+        analysis_obj = _resolve_analysis(request, analysisid, 'base.change_resourcebase',
+                                         _PERMISSION_MSG_GENERIC, permission_required=True)
+    except PermissionDenied:
+        return HttpResponse(_PERMISSION_MSG_GENERIC, mimetype="text/plain", status=401)
+
+    versions = AnalysisVersion.objects.filter(analysis=analysis_obj).values_list(
+        'number', 'checkpoint', 'created', 'user__username')
+    return HttpResponse(json.dumps([{
+        'number': number,
+        'checkpoint': number == checkpoint,
+        'created': created.isoformat(),
+        'user': username,
+    } for number, checkpoint, created, username in versions]), mimetype='application/json', status=200)
+
+def analysis_version(request, analysisid, number):
+    """ Return the state of an analysis saved in a version. """
+    from analytics.history import get_state
+
+    try:
+        analysis_obj = _resolve_analysis(request, analysisid, 'base.change_resourcebase',
+                                         _PERMISSION_MSG_GENERIC, permission_required=True)
+        return HttpResponse(json.dumps(get_state(analysis_obj, number)), mimetype='application/json', status=200)
+    except PermissionDenied:
+        return HttpResponse(_PERMISSION_MSG_GENERIC, mimetype="text/plain", status=401)
+    except AnalysisVersion.DoesNotExist:
+        return HttpResponse(status=404)
+
+def analysis_version_restore(request, analysisid, number):
+    """ Restore the state of an analysis saved in a version, as a new version. """
+    from analytics.history import restore_version
+
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    try:
+        analysis_obj = _resolve_analysis(request, analysisid, 'base.change_resourcebase',
+                                         _PERMISSION_MSG_GENERIC, permission_required=True)
+        data = restore_version(analysis_obj, number, request.user)
+        return HttpResponse(data, mimetype='application/json', status=200)
+    except PermissionDenied:
+        return HttpResponse(_PERMISSION_MSG_GENERIC, mimetype="text/plain", status=401)
+    except AnalysisVersion.DoesNotExist:
+        return HttpResponse(status=404)
+
 def new_analysis_json(request):
     """ The view that saves a new analysis in the database. """
+    from analytics.history import record_version
+
     if request.method == 'POST':
         if not request.user.is_authenticated():
             return HttpResponse(
@@ -133,6 +248,7 @@ def new_analysis_json(request):
             analysis_obj = Analysis(owner=request.user, title=data['title'], abstract=data['abstract'], data=json.dumps(data['data']))
             analysis_obj.save()
             analysis_obj.set_default_permissions() # This needs to be after .save() so that the analysis has an id.
+            record_version(analysis_obj, request.user)
             return HttpResponse(analysis_obj.id, status=200, mimetype='text/plain')
 
         except (ValueError, KeyError):
@@ -162,7 +278,12 @@ def analysis_remove(request, analysisid, template='analytics/analysis_remove.htm
             )
 
 @login_required
+@profiled
 def analysis_metadata(request, analysisid, template='analytics/analysis_metadata.html'):
+    from geonode.base.forms import CategoryForm
+    from geonode.base.models import TopicCategory
+    from geonode.people.forms import ProfileForm
+    from analytics.forms import AnalysisForm
 
     analysis_obj = _resolve_analysis(request, analysisid, 'base.view_resourcebase', _PERMISSION_MSG_VIEW)
 
@@ -254,37 +375,67 @@ def analysis_metadata(request, analysisid, template='analytics/analysis_metadata
             author_form = ProfileForm(prefix="author")
             author_form.hidden = True
 
-    return render_to_response(template, RequestContext(request, {
-        "analysis": analysis_obj,
-        "analysis_form": analysis_form,
-        "poc_form": poc_form,
-        "author_form": author_form,
-        "category_form": category_form,
-    }))
+    with phase('serialization'):
+        return render_to_response(template, RequestContext(request, {
+            "analysis": analysis_obj,
+            "analysis_form": analysis_form,
+            "poc_form": poc_form,
+            "author_form": author_form,
+            "category_form": category_form,
+        }))
+
+def _requester(request):
+    """
+    Returns the key of the user for the admission control: the user id, or
+    the client address for anonymous users, taken from the
+    MANDOLINE_CLIENT_IP_HEADER header set by the reverse proxy if any.
+    """
+    if request.user.is_authenticated():
+        return request.user.id
+    header = settings.MANDOLINE_CLIENT_IP_HEADER
+    if header and request.META.get(header):
+        # The first address is the client's, the others are the proxies'
+        return request.META[header].split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR')
 
 @gzip_page
 @never_cache
 @csrf_exempt
+@profiled
 def mandoline_api(request):
     """
     View to communicate with mandoline.
     """
+    from analytics import mandoline
+    from analytics.mandoline import admission
+
     if request.method == 'POST':
         try:
-            request_json = json.loads(request.body)
-
-            if settings.ROLES_ENABLED:
-                request_json['role'] = settings.ANONYMOUS_GEOMONDRIAN_ROLE
-                if request.user.is_authenticated():
-                    queryset = request.user.geomondrianrole.get_queryset()
-                    if len(queryset) > 0:
-                        request_json['role'] = queryset[0].rolename
-            else:
-                if 'role' in request_json:
-                    del request_json['role']
-
-            data = _query_mandoline(json.dumps(request_json))
-            return HttpResponse(data, mimetype='application/json', status=200)
+            with phase('serialization'):
+                request_json = json.loads(request.body)
+
+            with phase('permissions'):
+                if settings.ROLES_ENABLED:
+                    request_json['role'] = settings.ANONYMOUS_GEOMONDRIAN_ROLE
+                    if request.user.is_authenticated():
+                        queryset = request.user.geomondrianrole.get_queryset()
+                        if len(queryset) > 0:
+                            request_json['role'] = queryset[0].rolename
+                else:
+                    if 'role' in request_json:
+                        del request_json['role']
+
+            requester = _requester(request)
+
+            data, encoding = mandoline.encoded_query(request_json, requester,
+                                                     request.META.get('HTTP_ACCEPT_ENCODING', ''))
+            response = HttpResponse(data, mimetype='application/json', status=200)
+            if encoding is not None:
+                # gzip_page leaves the responses with a Content-Encoding as they are
+                response['Content-Encoding'] = encoding
+                response['Content-Length'] = str(len(response.content))
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
 
         except ValueError:
             return HttpResponse(
@@ -294,20 +445,55 @@ def mandoline_api(request):
             )
         except socket.error:
             return HttpResponse(status=503) # Mandoline api unreachable
+        except admission.Rejected, e:
+            response = HttpResponse(status=503) # Query shed by the admission control
+            response['Retry-After'] = e.retry_after
+            return response
     else:
         return HttpResponse(status=405) # Method not available for this view
 
-def _query_mandoline(querystr):
-    """ Send the query to mandoline through a socket and return the result """
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((settings.MANDOLINE_HOST, settings.MANDOLINE_PORT))
+@never_cache
+@staff_member_required
+def mandoline_stats(request):
+    """ Metrics of the admission control and of the Mandoline servers in this process """
+    from analytics import mandoline
+
+    return HttpResponse(json.dumps(mandoline.stats()), mimetype='application/json', status=200)
 
-    s.send(querystr + '\r\n')
-    data = bytearray()
-    while 1:
-        chunk = s.recv(65536)
-        if not chunk:
-            break
-        data.extend(chunk)
+@never_cache
+@staff_member_required
+def analysis_profile(request, profile_id):
+    """ Download a profile of a request, see analytics.profiling """
+    profile = get_profile(profile_id)
+    if profile is None:
+        return HttpResponse(status=404)
+    response = HttpResponse(profile, mimetype='text/plain', status=200)
+    response['Content-Disposition'] = 'attachment; filename="profile-%s.txt"' % profile_id
+    return response
 
-    return data.decode(encoding='utf-8')
+@never_cache
+@csrf_exempt
+def mandoline_invalidate(request):
+    """
+    Receives the notifications of the ETL about the cubes it changed, a JSON
+    notification or list of notifications (see generations.notify). The
+    requests must have the MANDOLINE_INVALIDATION_TOKEN in the
+    X-Invalidation-Token header.
+    """
+    from analytics.mandoline import generations
+
+    token = settings.MANDOLINE_INVALIDATION_TOKEN
+    if not token or not constant_time_compare(request.META.get('HTTP_X_INVALIDATION_TOKEN', ''), token):
+        return HttpResponse(status=403)
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    try:
+        notifications = json.loads(request.body)
+        if not isinstance(notifications, list):
+            notifications = [notifications]
+        for notification in notifications:
+            generations.notify(notification)
+    except ValueError:
+        return HttpResponse(_NOT_A_VALID_JSON_DOC, mimetype="text/plain", status=400)
+    return HttpResponse(status=204)